@@ -0,0 +1,508 @@
+# loadtest.py - Sinh tải asyncio cho signaling server, đo throughput và p50/p99/p999
+#
+#   python loadtest.py 1k --spawn                 # tự chạy server.py ở cổng riêng rồi bắn tải
+#   python loadtest.py 10k --url http://127.0.0.1:10000
+#   python loadtest.py herd --spawn               # restart server rồi mọi client kết nối lại cùng lúc
+#   python loadtest.py push --spawn               # client dùng long-poll, /users có điều kiện, /lobby/stream
+#   python loadtest.py 1k --spawn --compare bench_results/<file cũ>.json
+#
+# Mỗi client giả lập làm giống game client: heartbeat + poll /users + /check-invite mỗi 3 giây,
+# thỉnh thoảng tạo phòng, vào phòng, mời người khác vào phòng mình; người được mời chấp nhận/từ chối
+# đúng lời mời đã nhận. Kịch bản push thay poll bằng long-poll (?wait=), /users?since= + If-None-Match,
+# /lobby/stream và quick-match. Kết quả lưu JSON trong bench_results/.
+import os
+import sys
+import base64
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from urllib.parse import urlsplit
+
+POLL_INTERVAL = 3.0         # như client thật: cập nhật lobby mỗi 3 giây
+P_CREATE_ROOM = 0.02        # xác suất mỗi lượt
+P_JOIN_ROOM = 0.02
+P_INVITE = 0.02
+P_MATCH = 0.01              # push: vào hàng quick-match
+P_ACCEPT = 0.5              # người được mời chấp nhận, còn lại từ chối
+P_STREAM = 0.5              # push: tỉ lệ client giữ /lobby/stream thay vì poll /users có điều kiện
+LONG_POLL_WAIT = 20         # push: ?wait= của /check-invite
+REPLY_WAIT = 5              # push: ?wait= của /invite-replies
+REPLY_WINDOW = 15           # người mời thôi chờ phản hồi sau khoảng này
+MATCH_WAIT = 10             # push: ?wait= của /matchmaking/status, hết thì huỷ vé
+MATCH_RATING = (800, 1600)
+RETRY_DELAY = 0.5           # client lỗi kết nối thì thử lại sau (không jitter -> herd)
+RECENT_ROOMS = 1000
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    "1k": {"users": 1000, "duration": 30, "herd": False, "push": False},
+    "10k": {"users": 10000, "duration": 30, "herd": False, "push": False},
+    "50k": {"users": 50000, "duration": 60, "herd": False, "push": False},
+    "herd": {"users": 10000, "duration": 30, "herd": True, "push": False},
+    "push": {"users": 1000, "duration": 30, "herd": False, "push": True},
+}
+
+
+# --- HTTP/1.1 keep-alive tối giản (không phụ thuộc thư viện ngoài) ---
+class Connection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=2 ** 22)
+
+    def close(self):
+        if self.writer is not None: self.writer.close()
+        self.writer = None
+
+    async def request(self, method: str, path: str, body=None, headers: Optional[Dict[str, str]] = None):
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        data = b""
+        if body is not None:
+            data = json.dumps(body).encode()
+            lines += ["Content-Type: application/json", f"Content-Length: {len(data)}"]
+        for k, v in (headers or {}).items(): lines.append(f"{k}: {v}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + data)
+        status_line = await self.reader.readline()
+        if not status_line: raise ConnectionError("closed")
+        status = int(status_line.split()[1])
+        resp_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""): break
+            k, _, v = line.decode("latin-1").partition(":")
+            resp_headers[k.strip().lower()] = v.strip()
+        if "content-length" in resp_headers:
+            payload = await self.reader.readexactly(int(resp_headers["content-length"]))
+        elif resp_headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if size == 0: break
+            payload = b"".join(c[:-2] for c in chunks)
+        else:
+            payload = b""
+        if resp_headers.get("connection") == "close": self.close()
+        return status, resp_headers, payload
+
+
+class Pool:
+    def __init__(self, url: str, size: int):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.slots = asyncio.Semaphore(size)
+        self.idle: List[Connection] = []
+
+    async def request(self, method, path, body=None, headers=None):
+        async with self.slots:
+            conn = self.idle.pop() if self.idle else None
+            if conn is not None:
+                try:
+                    return self._release(conn, await conn.request(method, path, body, headers))
+                except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                    # Server đã đóng kết nối keep-alive nhàn rỗi: thử lại một lần bằng kết nối mới
+                    conn.close()
+            conn = Connection(self.host, self.port)
+            try:
+                await conn.open()
+                return self._release(conn, await conn.request(method, path, body, headers))
+            except BaseException:
+                conn.close()
+                raise
+
+    def _release(self, conn: Connection, result):
+        if conn.writer is not None: self.idle.append(conn)
+        return result
+
+    def close(self):
+        for conn in self.idle: conn.close()
+        self.idle.clear()
+
+
+# --- đo đạc ---
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.active = True
+
+    async def call(self, pool: Pool, op: str, method: str, path: str, body=None, headers=None, ok=(200,)):
+        start = time.perf_counter()
+        try:
+            status, resp_headers, payload = await pool.request(method, path, body, headers)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            if self.active: self.errors[op] = self.errors.get(op, 0) + 1
+            raise ConnectionError(op)
+        if self.active:
+            self.latencies.setdefault(op, []).append(time.perf_counter() - start)
+            if status not in ok: self.errors[op] = self.errors.get(op, 0) + 1
+        return status, resp_headers, payload
+
+    def summary(self, duration: float, elapsed: float) -> Dict:
+        # rps tính trên thời lượng kịch bản; elapsed gồm cả thời gian chờ các request cuối trả về
+        ops = {}
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            lat = sorted(self.latencies.get(op, []))
+            ops[op] = {
+                "count": len(lat),
+                "errors": self.errors.get(op, 0),
+                "rps": round(len(lat) / duration, 1),
+                "p50_ms": percentile(lat, 0.50),
+                "p99_ms": percentile(lat, 0.99),
+                "p999_ms": percentile(lat, 0.999),
+                "max_ms": round(lat[-1] * 1000, 3) if lat else None,
+            }
+        total = sum(o["count"] for o in ops.values())
+        return {"elapsed": round(elapsed, 3), "requests": total, "rps": round(total / duration, 1), "ops": ops}
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    if not sorted_values: return None
+    idx = min(len(sorted_values) - 1, int(p * len(sorted_values)))
+    return round(sorted_values[idx] * 1000, 3)
+
+
+# --- client giả lập ---
+async def read_frame(reader: asyncio.StreamReader):
+    # Frame WebSocket từ server (không mask); trả về (opcode, payload)
+    head = await reader.readexactly(2)
+    length = head[1] & 0x7F
+    if length == 126: length = int.from_bytes(await reader.readexactly(2), "big")
+    elif length == 127: length = int.from_bytes(await reader.readexactly(8), "big")
+    return head[0] & 0x0F, await reader.readexactly(length)
+
+
+class Sim:
+    def __init__(self, pool: Pool, rec: Recorder, users: int, push: bool = False):
+        self.pool = pool
+        self.rec = rec
+        self.push = push              # True: long-poll, /users có điều kiện, /lobby/stream, matchmaking
+        self.names = [f"lt{i}" for i in range(users)]
+        self.rooms: Deque[str] = deque(maxlen=RECENT_ROOMS)
+        self.hosted: Dict[str, str] = {}      # username -> phòng mới nhất mình làm host, dùng để mời
+        self.awaiting: Dict[str, float] = {}  # người mời -> hạn chờ phản hồi accept/decline
+        self.stream_messages = 0
+        self.reconnected = 0          # số client đã heartbeat lại được sau restart
+        self.reconnect_since = 0.0
+        self.reconnect_time: Optional[float] = None
+
+    async def user(self, idx: int, stop: float, jitter: bool, track_reconnect: bool):
+        name = self.names[idx]
+        rec, pool = self.rec, self.pool
+        if jitter: await asyncio.sleep(min(random.random() * POLL_INTERVAL, max(0.0, stop - time.perf_counter())))
+        back_online = not track_reconnect
+        lobby = {"since": "", "etag": None}
+        streaming = self.push and random.random() < P_STREAM
+        listeners = []
+        # push: lời mời tới qua long-poll trên kết nối riêng; một phần client nhận lobby qua WebSocket
+        if self.push: listeners.append(asyncio.create_task(self.invite_listener(name, stop)))
+        if streaming: listeners.append(asyncio.create_task(self.lobby_stream(stop)))
+        try:
+            while time.perf_counter() < stop:
+                tick = time.perf_counter()
+                try:
+                    await rec.call(pool, "heartbeat", "POST", "/heartbeat",
+                                   {"username": name, "p2p_port": 40000 + idx % 20000, "lobby_state": "menu"})
+                    if not back_online:
+                        back_online = True
+                        self.reconnected += 1
+                        if self.reconnected == len(self.names):
+                            self.reconnect_time = time.perf_counter() - self.reconnect_since
+                    if not self.push:
+                        await rec.call(pool, "users", "GET", "/users")
+                        _, _, payload = await rec.call(pool, "check_invite", "GET", f"/check-invite/{name}")
+                        invite = json.loads(payload)
+                        if "room_id" in invite: await self.answer(name, invite)
+                    elif not streaming:
+                        await self.poll_lobby(lobby)
+                    if name in self.awaiting: await self.poll_replies(name, stop)
+                    roll = random.random()
+                    if roll < P_CREATE_ROOM:
+                        await self.create_room(name)
+                    elif roll < P_CREATE_ROOM + P_JOIN_ROOM and self.rooms:
+                        await rec.call(pool, "join_room", "POST", "/join-room",
+                                       {"username": name, "room_id": random.choice(self.rooms)}, ok=(200, 404))
+                    elif roll < P_CREATE_ROOM + P_JOIN_ROOM + P_INVITE:
+                        await self.send_invite(name)
+                    elif self.push and roll < P_CREATE_ROOM + P_JOIN_ROOM + P_INVITE + P_MATCH:
+                        await self.quick_match(name, idx, stop)
+                except ConnectionError:
+                    await asyncio.sleep(max(0.0, min(RETRY_DELAY, stop - time.perf_counter())))
+                    continue
+                # Không ngủ quá stop: lượt ngủ cuối không được tính vào thời gian đo
+                now = time.perf_counter()
+                await asyncio.sleep(max(0.0, min(POLL_INTERVAL - (now - tick), stop - now)))
+        finally:
+            for task in listeners: task.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+
+    async def create_room(self, name: str) -> Optional[str]:
+        status, _, payload = await self.rec.call(self.pool, "create_room", "POST", "/create-room",
+                                                 {"username": name, "p2p_port": 40000, "game_type": "chess"})
+        if status != 200: return None
+        room_id = json.loads(payload)["room_id"]
+        self.rooms.append(room_id)
+        self.hosted[name] = room_id
+        return room_id
+
+    async def send_invite(self, name: str):
+        # Mời vào phòng mình đang làm host (tạo nếu chưa có), rồi chờ phản hồi ở các lượt sau
+        target = random.choice(self.names)
+        if target == name: return
+        room_id = self.hosted.get(name) or await self.create_room(name)
+        if room_id is None: return
+        status, _, _ = await self.rec.call(self.pool, "send_invite", "POST", "/send-invite", {
+            "challenger": name, "target": target, "room_id": room_id, "game_type": "chess"}, ok=(200, 404))
+        if status == 200: self.awaiting[name] = time.perf_counter() + REPLY_WINDOW
+
+    async def answer(self, name: str, invite: Dict):
+        # Người được mời trả lời đúng lời mời mình đã nhận
+        verb = "accept" if random.random() < P_ACCEPT else "decline"
+        await self.rec.call(self.pool, f"{verb}_invite", "POST", f"/{verb}-invite/{name}/{invite['room_id']}")
+
+    async def poll_replies(self, name: str, stop: float):
+        wait = max(0.0, min(REPLY_WAIT, stop - time.perf_counter())) if self.push else 0
+        op = "invite_replies_wait" if wait else "invite_replies"
+        _, _, payload = await self.rec.call(self.pool, op, "GET", f"/invite-replies/{name}?wait={wait:.1f}")
+        if json.loads(payload).get("status") != "none" or time.perf_counter() > self.awaiting[name]:
+            del self.awaiting[name]
+
+    async def poll_lobby(self, lobby: Dict):
+        # Poll có điều kiện: chỉ lấy thay đổi sau "since", không đổi gì thì 304
+        headers = {"If-None-Match": lobby["etag"]} if lobby["etag"] else None
+        status, resp_headers, payload = await self.rec.call(
+            self.pool, "users_since", "GET", f"/users?since={lobby['since']}&fields=username,lobby_state",
+            headers=headers, ok=(200, 304))
+        if status == 200:
+            lobby["etag"] = resp_headers.get("etag")
+            lobby["since"] = json.loads(payload)["since"]
+
+    async def quick_match(self, name: str, idx: int, stop: float):
+        await self.rec.call(self.pool, "mm_enqueue", "POST", "/matchmaking/enqueue", {
+            "username": name, "p2p_port": 40000 + idx % 20000, "game_type": "chess",
+            "rating": random.randint(MATCH_RATING[0], MATCH_RATING[1])})
+        wait = max(0.0, min(MATCH_WAIT, stop - time.perf_counter()))
+        _, _, payload = await self.rec.call(self.pool, "mm_status_wait", "GET", f"/matchmaking/status/{name}?wait={wait:.1f}")
+        if "room_id" not in json.loads(payload):
+            await self.rec.call(self.pool, "mm_cancel", "POST", f"/matchmaking/cancel/{name}")
+
+    async def invite_listener(self, name: str, stop: float):
+        # Kết nối riêng cho long-poll để không giữ chỗ trong pool dùng chung
+        conn = Pool(f"http://{self.pool.host}:{self.pool.port}", 1)
+        try:
+            # Không mở long-poll mới ở giây cuối: chỉ làm tăng số request ngắn giả tạo
+            while (remaining := stop - time.perf_counter()) > 1:
+                try:
+                    _, _, payload = await self.rec.call(conn, "check_invite_wait", "GET",
+                                                        f"/check-invite/{name}?wait={min(LONG_POLL_WAIT, remaining):.1f}")
+                    invite = json.loads(payload)
+                    if "room_id" in invite: await self.answer(name, invite)
+                except ConnectionError:
+                    await asyncio.sleep(max(0.0, min(RETRY_DELAY, stop - time.perf_counter())))
+        finally:
+            conn.close()
+
+    async def lobby_stream(self, stop: float):
+        host, port = self.pool.host, self.pool.port
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(host, port, limit=2 ** 22)
+                key = base64.b64encode(os.urandom(16)).decode()
+                writer.write(f"GET /lobby/stream HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n"
+                             f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+                status_line = await reader.readline()
+                while (await reader.readline()) not in (b"\r\n", b""): pass
+                if status_line.split()[1:2] != [b"101"]: raise ConnectionError("upgrade")
+                await read_frame(reader)    # snapshot đầu tiên: tính là thời gian kết nối
+                if self.rec.active: self.rec.latencies.setdefault("lobby_stream", []).append(time.perf_counter() - start)
+                while True:
+                    opcode, _ = await asyncio.wait_for(read_frame(reader), max(0.0, stop - time.perf_counter()))
+                    if opcode == 8: break   # close
+                    if self.rec.active: self.stream_messages += 1
+            except asyncio.TimeoutError:
+                return
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, IndexError):
+                if self.rec.active: self.rec.errors["lobby_stream"] = self.rec.errors.get("lobby_stream", 0) + 1
+            finally:
+                if writer is not None: writer.close()
+            await asyncio.sleep(max(0.0, min(RETRY_DELAY, stop - time.perf_counter())))
+
+    async def run(self, duration: float, jitter: bool = True, track_reconnect: bool = False):
+        stop = time.perf_counter() + duration
+        self.reconnect_since = time.perf_counter()
+        await asyncio.gather(*(self.user(i, stop, jitter, track_reconnect) for i in range(len(self.names))))
+
+
+# --- server cục bộ ---
+def db_path(port: int) -> str:
+    return os.path.join(HERE, "bench_results", f"loadtest-{port}.db")
+
+
+def remove_db(port: int):
+    # Mỗi lần đo bắt đầu với state trống: phòng, lobby log, bộ cấp room_id của lần trước làm lệch kết quả
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(db_path(port) + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def spawn_server(port: int, backend: str) -> subprocess.Popen:
+    env = dict(os.environ, PORT=str(port), STATE_BACKEND=backend, STATE_DB_PATH=db_path(port))
+    return subprocess.Popen([sys.executable, "server.py"], cwd=HERE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(url: str, timeout: float = 20):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        conn = Connection(parts.hostname, parts.port or 80)
+        try:
+            await conn.open()
+            status, _, _ = await conn.request("GET", "/")
+            conn.close()
+            if status == 200: return
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit(f"server không lên ở {url}")
+
+
+# --- kết quả ---
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(result: Dict):
+    print(f"\n{result['scenario']}: {result['users']} users, {result['summary']['requests']} requests "
+          f"in {result['duration']}s (elapsed {result['summary']['elapsed']}s) -> {result['summary']['rps']} req/s")
+    if result.get("reconnect_seconds") is not None:
+        print(f"herd: mọi client heartbeat lại được sau {result['reconnect_seconds']}s")
+    if result.get("stream_messages"):
+        print(f"lobby/stream: {result['stream_messages']} message nhận được")
+    print(f"{'op':<20}{'count':>9}{'err':>7}{'rps':>9}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for op, s in result["summary"]["ops"].items():
+        print(f"{op:<20}{s['count']:>9}{s['errors']:>7}{s['rps']:>9}"
+              f"{str(s['p50_ms']):>10}{str(s['p99_ms']):>10}{str(s['p999_ms']):>10}{str(s['max_ms']):>10}")
+
+
+def print_compare(result: Dict, baseline: Dict):
+    when = time.strftime("%Y-%m-%d %H:%M", time.localtime(baseline["timestamp"]))
+    print(f"\nso với {baseline.get('commit')} ({when}, {baseline['users']} users):")
+    delta = lambda new, old: f"{(new - old) / old * 100:+.1f}%" if new is not None and old else "n/a"
+    print(f"  throughput {baseline['summary']['rps']} -> {result['summary']['rps']} req/s "
+          f"({delta(result['summary']['rps'], baseline['summary']['rps'])})")
+    for op, s in result["summary"]["ops"].items():
+        old = baseline["summary"]["ops"].get(op)
+        if not old: continue
+        print(f"  {op:<20} p50 {delta(s['p50_ms'], old['p50_ms']):>8}   p99 {delta(s['p99_ms'], old['p99_ms']):>8}"
+              f"   p999 {delta(s['p999_ms'], old['p999_ms']):>8}")
+
+
+def save_result(result: Dict, out_dir: str) -> str:
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(result["timestamp"]))
+    path = os.path.join(out_dir, f"{stamp}-{result['scenario']}-{result.get('commit') or 'nogit'}.json")
+    with open(path, "w") as f: json.dump(result, f, indent=2)
+    return path
+
+
+async def main(args):
+    scenario = dict(SCENARIOS[args.scenario])
+    if args.users: scenario["users"] = args.users
+    if args.duration: scenario["duration"] = args.duration
+    url = args.url
+    server = None
+    if args.spawn:
+        os.makedirs(os.path.join(HERE, "bench_results"), exist_ok=True)
+        url = f"http://127.0.0.1:{args.port}"
+        remove_db(args.port)  # herd restart bên dưới vẫn giữ file này
+        server = spawn_server(args.port, args.backend)
+    try:
+        await wait_ready(url)
+        pool = Pool(url, args.connections)
+        rec = Recorder()
+        sim = Sim(pool, rec, scenario["users"], push=scenario["push"])
+        reconnect = None
+        if scenario["herd"]:
+            # Làm ấm rồi restart server: mọi client lỗi cùng lúc và thử lại cùng nhịp
+            rec.active = False
+            warm = asyncio.create_task(sim.run(args.warmup + scenario["duration"] + 60, jitter=True))
+            await asyncio.sleep(args.warmup)
+            if server is not None:
+                server.terminate()
+                server.wait()
+                server = spawn_server(args.port, args.backend)
+                await wait_ready(url)
+            warm.cancel()
+            await asyncio.gather(warm, return_exceptions=True)
+            pool.close()
+            pool = sim.pool = Pool(url, args.connections)
+            rec = sim.rec = Recorder()
+            started = time.perf_counter()
+            await sim.run(scenario["duration"], jitter=False, track_reconnect=True)
+            if sim.reconnect_time is not None: reconnect = round(sim.reconnect_time, 3)
+        else:
+            rec.active = False
+            await sim.run(args.warmup)
+            rec = sim.rec = Recorder()
+            started = time.perf_counter()
+            await sim.run(scenario["duration"])
+        elapsed = time.perf_counter() - started
+        pool.close()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    result = {
+        "scenario": args.scenario,
+        "users": scenario["users"],
+        "duration": scenario["duration"],
+        "connections": args.connections,
+        "backend": args.backend if args.spawn else None,
+        "url": url,
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "reconnect_seconds": reconnect,
+        "stream_messages": sim.stream_messages,
+        "summary": rec.summary(scenario["duration"], elapsed),
+    }
+    print_summary(result)
+    if args.compare:
+        with open(args.compare) as f: print_compare(result, json.load(f))
+    if not args.no_save: print(f"\nđã lưu {save_result(result, args.out)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test cho signaling server")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--url", default="http://127.0.0.1:10000")
+    parser.add_argument("--spawn", action="store_true", help="tự chạy server.py (bắt buộc để herd restart thật)")
+    parser.add_argument("--port", type=int, default=18000, help="cổng cho server tự chạy")
+    parser.add_argument("--backend", default="memory", choices=["memory", "sqlite"])
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--connections", type=int, default=256, help="số kết nối keep-alive dùng chung")
+    parser.add_argument("--out", default="bench_results")
+    parser.add_argument("--compare", help="file JSON kết quả cũ để so sánh")
+    parser.add_argument("--no-save", action="store_true")
+    asyncio.run(main(parser.parse_args()))
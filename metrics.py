@@ -0,0 +1,195 @@
+# metrics.py - Metric dạng Prometheus (text format 0.0.4) và sampling profiler, không cần thư viện ngoài
+import sys
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter as Tally
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"): return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value) -> str:
+    # Text format 0.0.4: trong label value phải escape \, " và xuống dòng
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_fmt(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set_total(self, value: float, *labels: str):
+        # Counter được đếm ở nơi khác (store, relay), chỉ chép lại lúc scrape
+        self.values[labels] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(buckets)
+        # labels -> [đếm theo bucket (không cộng dồn)..., +Inf, tổng]
+        self.series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None: series = self.series[labels] = [0] * (len(self.bounds) + 2)
+        series[bisect_left(self.bounds, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            total = 0
+            for bound, count in zip(self.bounds + (float("inf"),), series):
+                total += count
+                le = 'le="' + _fmt(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_fmt(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []  # chạy lúc scrape để cập nhật gauge
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn: Callable[[], None]) -> Callable[[], None]:
+        self.collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for fn in self.collectors: fn()
+        lines: List[str] = []
+        for metric in self.metrics: lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware đo latency theo route template (không theo path thật để tránh bùng nổ label)."""
+
+    def __init__(self, app, latency: Histogram, requests: Counter, in_flight: Gauge):
+        self.app = app
+        self.latency = latency
+        self.requests = requests
+        self.in_flight = in_flight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start": status[0] = message["status"]
+            await send(message)
+
+        self.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", "other")
+            self.latency.observe(time.perf_counter() - start, path)
+            self.requests.inc(path, scope["method"], str(status[0]))
+            self.in_flight.inc(amount=-1)
+
+
+class SamplingProfiler:
+    """Lấy mẫu stack của một thread (event loop) theo chu kỳ, gom thành dạng collapsed stack."""
+
+    def __init__(self):
+        self.samples: Tally = Tally()
+        self.sample_count = 0
+        self.lock = threading.Lock()        # samples bị thread lấy mẫu ghi trong khi report() đọc
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.started_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, target_thread_id: int, interval: float, max_depth: int = 40):
+        if self.running: return
+        with self.lock:
+            self.samples.clear()
+            self.sample_count = 0
+        self.stop_event.clear()
+        self.started_at = time.time()
+        self.thread = threading.Thread(
+            target=self._run, args=(target_thread_id, interval, max_depth), name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running: return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self, target_thread_id: int, interval: float, max_depth: int):
+        while not self.stop_event.wait(interval):
+            frame = sys._current_frames().get(target_thread_id)
+            stack = []
+            while frame is not None and len(stack) < max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            with self.lock:
+                self.samples[key] += 1
+                self.sample_count += 1
+
+    def report(self, limit: int = 50) -> str:
+        # Mỗi dòng "stack;con;... số_mẫu", dùng trực tiếp cho flamegraph.pl / speedscope
+        with self.lock:
+            samples = self.samples.copy()
+        return "\n".join(f"{stack} {count}" for stack, count in samples.most_common(limit)) + "\n"
@@ -0,0 +1,193 @@
+# relay.py - Chuyển tiếp TCP giữa host và khách khi không kết nối P2P trực tiếp được (NAT đối xứng)
+#
+# Mỗi peer mở TCP tới RELAY_PORT và gửi 1 dòng "<token>\n". Token do /join-room cấp,
+# ký HMAC nên tiến trình nào cũng cấp được mà không cần chia sẻ session.
+# Khi đủ host + guest cùng room_id, relay trả "OK\n" cho cả hai rồi chuyển byte hai chiều.
+import hmac
+import time
+import asyncio
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple
+
+RELAY_CHUNK = 16 * 1024             # byte đọc mỗi lần
+RELAY_BUFFER = 64 * 1024            # ngưỡng write buffer; vượt ngưỡng thì drain() chặn bên đọc
+RELAY_HANDSHAKE_TIMEOUT = 10
+RELAY_PAIR_TIMEOUT = 30             # giây chờ peer còn lại
+RELAY_TOKEN_TTL = 60                # token phải được dùng trong khoảng này
+RELAY_LATENCY_ALPHA = 0.1           # hệ số EWMA độ trễ chuyển tiếp
+
+
+class RelaySession:
+    __slots__ = ("room_id", "peers", "ready", "early", "bytes", "chunks", "latency", "started_at")
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.peers: Dict[str, Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = {}
+        self.ready = asyncio.Event()
+        self.early = {"host": b"", "guest": b""}  # byte peer gửi trước khi có OK, chuyển khi session chạy
+        self.bytes = {"host": 0, "guest": 0}    # byte gửi đi theo vai trò người gửi
+        self.chunks = 0
+        self.latency = 0.0                      # EWMA thời gian từ lúc đọc xong tới lúc drain xong
+        self.started_at = 0.0
+
+    def summary(self, now: float) -> Dict:
+        elapsed = max(now - self.started_at, 1e-6)
+        total = self.bytes["host"] + self.bytes["guest"]
+        return {
+            "room_id": self.room_id,
+            "duration": round(elapsed, 3),
+            "bytes_host": self.bytes["host"],
+            "bytes_guest": self.bytes["guest"],
+            "throughput_bps": round(total / elapsed, 1),
+            "latency_ms": round(self.latency * 1000, 3),
+        }
+
+
+class Relay:
+    def __init__(self, secret: bytes):
+        self.secret = secret
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.waiting: Dict[str, RelaySession] = {}  # room_id -> session chờ peer thứ hai
+        self.active: Set[RelaySession] = set()
+        self.totals = {"sessions": 0, "bytes": 0, "rejected": 0, "timeouts": 0}
+
+    # --- token ---
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def issue_token(self, room_id: str, role: str) -> str:
+        payload = f"{room_id}.{role}.{int(time.time()) + RELAY_TOKEN_TTL}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify_token(self, token: str) -> Optional[Tuple[str, str]]:
+        parts = token.split(".")
+        if len(parts) != 4: return None
+        room_id, role, expires, sig = parts
+        if role not in ("host", "guest") or not expires.isdigit(): return None
+        if not hmac.compare_digest(sig, self._sign(f"{room_id}.{role}.{expires}")): return None
+        if int(expires) < time.time(): return None
+        return room_id, role
+
+    # --- server ---
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.handle, host, port, limit=RELAY_BUFFER)
+
+    async def stop(self):
+        if self.server is None: return
+        self.server.close()
+        for session in list(self.active) + list(self.waiting.values()):
+            for _, writer in session.peers.values(): writer.close()
+        await self.server.wait_closed()
+
+    async def _reject(self, writer: asyncio.StreamWriter, reason: bytes):
+        self.totals["rejected"] += 1
+        writer.write(b"ERR " + reason + b"\n")
+        writer.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = await asyncio.wait_for(reader.readline(), RELAY_HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            writer.close()
+            return
+        claim = self.verify_token(line.decode(errors="replace").strip())
+        if claim is None: return await self._reject(writer, b"token")
+        room_id, role = claim
+        session = self.waiting.get(room_id)
+        if session is None: session = self.waiting[room_id] = RelaySession(room_id)
+        if role in session.peers: return await self._reject(writer, b"duplicate")
+        session.peers[role] = (reader, writer)
+        if len(session.peers) < 2:
+            # Peer đến trước chờ rồi chạy session (nó đang giữ lệnh read trên socket của mình);
+            # peer đến sau chỉ báo ready
+            result = await self._wait_partner(session, role, reader)
+            if result == "ready": return await self.run(session)
+            # Mất kết nối hoặc hết giờ: rời session ngay để kết nối lại / peer kia không ghép với socket chết
+            del session.peers[role]
+            if self.waiting.get(room_id) is session: del self.waiting[room_id]
+            if result == "timeout":
+                self.totals["timeouts"] += 1
+                writer.write(b"ERR timeout\n")
+            writer.close()
+            return
+        del self.waiting[room_id]
+        session.ready.set()
+
+    async def _wait_partner(self, session: RelaySession, role: str, reader: asyncio.StreamReader) -> str:
+        """Chờ peer còn lại, đồng thời đọc socket của mình để biết peer đã ngắt (EOF) chưa.
+        Trả về "ready", "gone" hoặc "timeout"."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RELAY_PAIR_TIMEOUT
+        ready = asyncio.ensure_future(session.ready.wait())
+        read = None
+        try:
+            while True:
+                read = asyncio.ensure_future(reader.read(RELAY_CHUNK))
+                done, _ = await asyncio.wait({ready, read}, timeout=deadline - loop.time(),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if read not in done:
+                    read.cancel()
+                    await asyncio.wait({read})   # pipe chỉ đọc được khi lệnh read này đã nhả reader
+                if not read.cancelled():
+                    try:
+                        data = read.result()
+                    except (ConnectionError, OSError):
+                        data = b""
+                    session.early[role] += data
+                    if not ready.done() and (not data or len(session.early[role]) > RELAY_BUFFER): return "gone"
+                if ready.done(): return "ready"
+                if read.cancelled(): return "timeout"
+        finally:
+            ready.cancel()
+            if read is not None: read.cancel()
+
+    async def run(self, session: RelaySession):
+        loop = asyncio.get_running_loop()
+        session.started_at = loop.time()
+        self.active.add(session)
+        self.totals["sessions"] += 1
+        (host_r, host_w), (guest_r, guest_w) = session.peers["host"], session.peers["guest"]
+        for w in (host_w, guest_w):
+            w.transport.set_write_buffer_limits(high=RELAY_BUFFER)
+            w.write(b"OK\n")
+        host_w.write(session.early["guest"])
+        guest_w.write(session.early["host"])
+        session.bytes["host"], session.bytes["guest"] = len(session.early["host"]), len(session.early["guest"])
+        try:
+            await asyncio.gather(
+                self.pipe(session, "host", host_r, guest_w),
+                self.pipe(session, "guest", guest_r, host_w),
+            )
+        finally:
+            self.active.discard(session)
+            self.totals["bytes"] += session.bytes["host"] + session.bytes["guest"]
+            for w in (host_w, guest_w): w.close()
+
+    async def pipe(self, session: RelaySession, role: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await reader.read(RELAY_CHUNK)
+                if not data: break
+                start = loop.time()
+                writer.write(data)
+                # Backpressure: bên nhận chậm thì ngừng đọc bên gửi thay vì phình buffer
+                await writer.drain()
+                session.latency += RELAY_LATENCY_ALPHA * (loop.time() - start - session.latency)
+                session.bytes[role] += len(data)
+                session.chunks += 1
+            if writer.can_write_eof(): writer.write_eof()
+        except (ConnectionError, OSError):
+            writer.close()
+
+    def stats(self, limit: int = 100) -> Dict:
+        now = asyncio.get_running_loop().time()
+        sessions: List[Dict] = sorted(
+            (s.summary(now) for s in self.active), key=lambda s: s["throughput_bps"], reverse=True)
+        return {
+            "enabled": self.server is not None,
+            "active": len(self.active),
+            "waiting": len(self.waiting),
+            "totals": dict(self.totals, bytes=self.totals["bytes"] + sum(s["bytes_host"] + s["bytes_guest"] for s in sessions)),
+            "sessions": sessions[:limit],
+        }
@@ -1,13 +1,102 @@
 # server.py (Bản Hoàn Chỉnh - Fix lỗi thiếu hàm)
 import os
+import json
 import time
-import random
-from typing import Dict, Optional
-from fastapi import FastAPI, Request, HTTPException
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from fastapi import FastAPI, Header, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ValidationError
+from store import RoomsFull, StoreBusy, open_store
+from relay import RELAY_TOKEN_TTL, Relay
+from metrics import Counter, Gauge, Histogram, MetricsMiddleware, Registry, SamplingProfiler
 
-app = FastAPI()
+try:
+    import msgpack  # tuỳ chọn: client gửi Accept: application/msgpack
+except ImportError:
+    msgpack = None
+
+LOBBY_BATCH_WINDOW = 0.25   # giây gom sự kiện lobby trước khi đẩy
+LOBBY_LOG_SIZE = 10000      # số sự kiện lobby giữ lại trong log
+LOBBY_QUEUE_LIMIT = 64      # số batch tối đa chờ gửi cho mỗi client
+USER_TTL = 15               # giây không heartbeat thì coi là offline
+ROOM_TTL = 1800
+INVITE_TTL = 10             # lời mời chưa được nhận sau 10 giây thì bỏ
+INVITE_ANSWER_TTL = 60      # lời mời đã giao tới người chơi: thời gian để bấm accept/decline
+INVITE_QUEUE_LIMIT = 8      # số lời mời tối đa đang chờ cho mỗi người
+INVITE_WAIT_MAX = 30        # giây tối đa giữ một request long-poll
+SWEEP_INTERVAL = 1.0
+ROOMS_PAGE_MAX = 100
+MM_TICK = 0.2               # chu kỳ ghép trận
+MM_RATING_BUCKET = 100      # độ rộng bucket rating
+MM_WIDEN_AFTER = 5.0        # mỗi 5 giây chờ được ghép xa thêm 1 bucket
+MM_TICKET_TTL = 120
+MATCH_RESULT_TTL = MM_TICKET_TTL  # kết quả ghép giữ lâu bằng vé: phòng đã tạo, không được mất
+MM_STATS_WINDOW = 1000      # số trận gần nhất để tính time-to-match
+LOBBY_FIELDS = ("username", "lobby_state")
+GZIP_MIN_SIZE = 1024
+LOOP_LAG_INTERVAL = 0.5     # chu kỳ đo độ trễ event loop
+PROFILE_INTERVAL = 0.005    # mặc định 200 mẫu/giây
+MAIL_POLL_SLICE = 0.5       # store dùng chung: worker khác không đánh thức được, kiểm tra lại định kỳ
+
+# memory: 1 tiến trình; sqlite: nhiều worker trên cùng một máy dùng chung file STATE_DB_PATH (WAL cần shared memory)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "signaling.db")
+# Số thread gọi store dùng chung (sqlite) trong mỗi worker; event loop không bao giờ chờ I/O hay lock
+STORE_THREADS = int(os.environ.get("STORE_THREADS", 4))
+# Relay TCP cho peer không kết nối P2P được; 0 = tắt. Nhiều worker thì chỉ worker bind được cổng chạy relay,
+# nên bắt buộc đặt RELAY_SECRET chung để token do worker khác cấp vẫn hợp lệ (không có thì không khởi động).
+RELAY_PORT = int(os.environ.get("RELAY_PORT", 0))
+RELAY_PUBLIC_HOST = os.environ.get("RELAY_PUBLIC_HOST")
+RELAY_SECRET = os.environ.get("RELAY_SECRET", "").encode() or os.urandom(32)
+# Đặt PROFILER_TOKEN để bật /debug/profile/* (gửi kèm header X-Profiler-Token)
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [
+        asyncio.create_task(lobby_broadcaster()),
+        asyncio.create_task(expiry_sweeper()),
+        asyncio.create_task(matchmaker()),
+        asyncio.create_task(loop_lag_monitor()),
+    ]
+    if RELAY_PORT:
+        try:
+            await relay.start("0.0.0.0", RELAY_PORT)
+        except OSError:
+            print(f"[RELAY] port {RELAY_PORT} đã có worker khác giữ")
+    yield
+    for t in tasks: t.cancel()
+    await relay.stop()
+    profiler.stop()
+    if store_executor is not None: store_executor.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+
+# --- METRICS ---
+registry = Registry()
+http_latency = registry.add(Histogram("signaling_http_request_duration_seconds", "HTTP latency by route", ["route"]))
+http_requests = registry.add(Counter("signaling_http_requests_total", "HTTP requests", ["route", "method", "status"]))
+http_in_flight = registry.add(Gauge("signaling_http_in_flight", "HTTP requests in progress"))
+state_entries = registry.add(Gauge("signaling_state_entries", "Live entries per state table", ["table"]))
+evictions = registry.add(Counter("signaling_evictions_total", "Entries removed by expiry, by kind", ["kind"]))
+cleanup_duration = registry.add(Histogram("signaling_cleanup_duration_seconds", "cleanup_stale_data() duration"))
+invite_events = registry.add(Counter("signaling_invites_total", "Invite lifecycle events", ["event"]))
+mm_depth = registry.add(Gauge("signaling_matchmaking_queue_depth", "Queued tickets per game type", ["game_type"]))
+mm_wait = registry.add(Histogram("signaling_matchmaking_wait_seconds", "Time from enqueue to match"))
+stream_clients = registry.add(Gauge("signaling_lobby_stream_clients", "Open /lobby/stream sockets"))
+relay_sessions = registry.add(Gauge("signaling_relay_sessions", "Relay sessions by state", ["state"]))
+relay_bytes = registry.add(Counter("signaling_relay_bytes_total", "Bytes forwarded by the relay"))
+loop_lag = registry.add(Gauge("signaling_event_loop_lag_seconds", "Last measured event loop lag"))
+loop_lag_hist = registry.add(Histogram("signaling_event_loop_lag_distribution_seconds", "Event loop lag samples"))
+profiler = SamplingProfiler()
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,10 +105,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+app.add_middleware(MetricsMiddleware, latency=http_latency, requests=http_requests, in_flight=http_in_flight)
 
-online_users: Dict[str, Dict] = {}
-rooms: Dict[str, Dict] = {}
-invites: Dict[str, Dict] = {} 
+@app.exception_handler(StoreBusy)
+async def store_busy(request: Request, exc: StoreBusy):
+    # Store dùng chung đang bị worker khác giữ lock quá lâu: báo client thử lại thay vì treo
+    return JSONResponse({"detail": "State store busy"}, status_code=503, headers={"Retry-After": "1"})
+
+store = open_store(
+    STATE_BACKEND, STATE_DB_PATH,
+    user_ttl=USER_TTL, room_ttl=ROOM_TTL, mail_ttl=INVITE_TTL,
+    mail_limit=INVITE_QUEUE_LIMIT, log_size=LOBBY_LOG_SIZE, ticket_ttl=MM_TICKET_TTL,
+    mail_ttls={"match": MATCH_RESULT_TTL, "relay": RELAY_TOKEN_TTL}, answer_ttl=INVITE_ANSWER_TTL,
+)
+store_executor = ThreadPoolExecutor(STORE_THREADS, thread_name_prefix="store") if store.shared else None
+# Long-poll đang chờ trong tiến trình này; entry bị xoá khi không còn ai chờ
+mailbox_events: Dict[str, asyncio.Event] = {}
+mailbox_waiters: Dict[str, int] = {}
+lobby_subscribers: Set[asyncio.Queue] = set()
+relay = Relay(RELAY_SECRET)
+# Body /users đã encode sẵn theo (full?, fields, định dạng) -> (etag, body); poll lặp lại không serialize lại
+users_cache: Dict[Tuple, Tuple[str, bytes, str]] = {}
+# Thời gian chờ (giây) của các trận do tiến trình này ghép
+match_waits: Deque[float] = deque(maxlen=MM_STATS_WINDOW)
+matches_total = 0
 
 # --- MODELS ---
 class UserSignal(BaseModel):
@@ -37,6 +147,15 @@ class CreateRoomRequest(BaseModel):
 class JoinRoomRequest(BaseModel):
     username: str
     room_id: str
+    relay: bool = False  # True: P2P trực tiếp thất bại, đi qua relay của server
+
+class MatchRequest(BaseModel):
+    username: str
+    p2p_port: int
+    game_type: str
+    rating: int = 1000
+    region: str = "global"
+    ip: Optional[str] = None
 
 class InviteRequest(BaseModel):
     challenger: str 
@@ -46,99 +165,465 @@ class InviteRequest(BaseModel):
     ip: Optional[str] = None
 
 # --- HELPERS (ĐÃ BỔ SUNG) ---
-def cleanup_stale_data():
+async def call_store(fn, *args):
+    # MemoryStore chỉ là thao tác dict: gọi thẳng. SqliteStore chặn (I/O, chờ write lock của worker khác)
+    # nên chạy trong thread pool để WebSocket, long-poll và relay không bị đứng theo.
+    if store_executor is None: return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(store_executor, fn, *args)
+
+async def cleanup_stale_data():
+    start = time.perf_counter()
+    for username in await call_store(store.expire): notify_mailbox(username)
+    cleanup_duration.observe(time.perf_counter() - start)
+
+def notify_mailbox(username: str):
+    # Đánh thức mọi request long-poll đang chờ của username
+    event = mailbox_events.pop(username, None)
+    if event: event.set()
+
+async def wait_mailbox(username: str, timeout: float) -> bool:
+    """True nếu được notify_mailbox đánh thức, False nếu hết timeout."""
+    event = mailbox_events.get(username)
+    if event is None: event = mailbox_events[username] = asyncio.Event()
+    mailbox_waiters[username] = mailbox_waiters.get(username, 0) + 1
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        left = mailbox_waiters.pop(username) - 1
+        if left: mailbox_waiters[username] = left
+        elif mailbox_events.get(username) is event: del mailbox_events[username]
+
+async def push_mail(kind: str, username: str, item: Dict, replace_from: Optional[str] = None):
+    await call_store(store.push_mail, kind, username, item, replace_from)
+    notify_mailbox(username)
+
+async def poll_mail(kind: str, username: str, wait: float, mark_delivered: bool = False):
+    item = await call_store(store.take_mail, kind, username, mark_delivered)
+    deadline = time.time() + min(wait, INVITE_WAIT_MAX)
+    while item is None and (remaining := deadline - time.time()) > 0:
+        if store.shared: remaining = min(remaining, MAIL_POLL_SLICE)
+        woken = await wait_mailbox(username, remaining)
+        item = await call_store(store.take_mail, kind, username, mark_delivered)
+        # Bị đánh thức mà không có thư: có thể do sweeper vừa cho username offline -> trả về luôn
+        if woken and item is None and await call_store(store.get_user, username) is None: break
+    return item
+
+async def expiry_sweeper():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            await cleanup_stale_data()
+        except StoreBusy:
+            pass  # worker khác đang giữ lock, lượt sau quét tiếp
+
+async def loop_lag_monitor():
+    # Ngủ LOOP_LAG_INTERVAL rồi đo thời gian thừa: handler nào chặn loop sẽ làm số này tăng
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - start - LOOP_LAG_INTERVAL)
+        loop_lag.set(lag)
+        loop_lag_hist.observe(lag)
+
+def store_gauges():
+    return store.counts(), store.mm_depth()
+
+@registry.collector
+def collect_state():
+    for kind, n in list(store.evicted.items()): evictions.set_total(n, kind)
+    stream_clients.set(len(lobby_subscribers))
+    relay_sessions.set(len(relay.active), "active")
+    relay_sessions.set(len(relay.waiting), "waiting")
+    relay_bytes.set_total(relay.totals["bytes"] + sum(s.bytes["host"] + s.bytes["guest"] for s in relay.active))
+
+def open_match_room(host: Dict, guest: Dict, now: float) -> Optional[str]:
+    # Ghép xong thì tạo phòng như /create-room, khách chiếm chỗ như /join-room
+    try:
+        room_id = store.create_room({
+            "host_username": host["username"],
+            "host_ip": host["ip"],
+            "host_port": host["port"],
+            "game_type": host["game_type"],
+            "created_at": now
+        })
+    except RoomsFull:
+        for t in (host, guest): store.mm_enqueue(t)
+        return None
+    store.join_room(room_id, guest["username"])
+    return room_id
+
+async def matchmaker():
+    while True:
+        await asyncio.sleep(MM_TICK)
+        try:
+            await match_tick()
+        except StoreBusy:
+            pass
+
+async def match_tick():
+    global matches_total
+    pairs = await call_store(store.mm_match, MM_WIDEN_AFTER)
     now = time.time()
-    expired_users = [u for u, data in online_users.items() if now - data['last_seen'] > 15]
-    for u in expired_users: del online_users[u]
-    
-    expired_rooms = [rid for rid, r in rooms.items() if now - r['created_at'] > 1800]
-    for rid in expired_rooms: del rooms[rid]
+    for host, guest in pairs:
+        room_id = await call_store(open_match_room, host, guest, now)
+        if room_id is None: continue
+        result = {
+            "status": "matched",
+            "room_id": room_id,
+            "host_ip": host["ip"],
+            "host_port": host["port"],
+            "host_username": host["username"],
+            "game_type": host["game_type"],
+            "timestamp": now
+        }
+        await push_mail("match", host["username"], dict(result, role="host", opponent=guest["username"]))
+        await push_mail("match", guest["username"], dict(result, role="guest", opponent=host["username"]))
+        for t in (host, guest):
+            match_waits.append(now - t["enqueued_at"])
+            mm_wait.observe(now - t["enqueued_at"])
+        matches_total += 1
+
+def lobby_events_since(version: int):
+    """Sự kiện có v > version, đã gộp theo username (giữ sự kiện cuối)."""
+    batch: Dict[str, Dict] = {}
+    for event in reversed(store.lobby_log_since(version)):
+        u = event["username"]
+        if u not in batch:
+            batch[u] = event
+        elif event["type"] == "join" and batch[u]["type"] == "state":
+            # join rồi đổi state trong cùng cửa sổ -> vẫn là join
+            batch[u] = dict(batch[u], type="join")
+    return sorted(batch.values(), key=lambda e: e["v"])
+
+async def lobby_broadcaster():
+    # Gom sự kiện theo cửa sổ LOBBY_BATCH_WINDOW, serialize một lần cho mọi client
+    sent = await call_store(store.lobby_version)
+    while True:
+        await asyncio.sleep(LOBBY_BATCH_WINDOW)
+        version = await call_store(store.lobby_version)
+        if version == sent: continue
+        events = await call_store(lobby_events_since, sent)
+        sent = max(e["v"] for e in events) if events else version
+        if not lobby_subscribers: continue
+        msg = json.dumps({"type": "batch", "version": sent, "events": events})
+        for queue in list(lobby_subscribers):
+            if queue.full():
+                # Client quá chậm: ngắt để nó kết nối lại và nhận snapshot mới
+                lobby_subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(msg)
+
+def wants_msgpack(request: Request) -> bool:
+    return msgpack is not None and "msgpack" in request.headers.get("accept", "")
+
+def encode_body(data, as_msgpack: bool) -> Tuple[bytes, str]:
+    if as_msgpack: return msgpack.packb(data), "application/msgpack"
+    return json.dumps(data, separators=(",", ":")).encode(), "application/json"
+
+def encode_response(data, request: Request) -> Response:
+    body, media_type = encode_body(data, wants_msgpack(request))
+    return Response(body, media_type=media_type)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header: return False
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def parse_since(since: Optional[str]) -> Optional[int]:
+    # Version chỉ có nghĩa trong cùng epoch: sau restart version đếm lại từ 0
+    epoch, _, version = (since or "").partition("-")
+    if epoch != str(store.epoch) or not version.isdigit(): return None
+    return int(version)
+
+def project(items: List[Dict], fields: Optional[Tuple[str, ...]]) -> List[Dict]:
+    # Bỏ các trường lobby client không cần; sự kiện vẫn giữ type/v
+    if fields is None: return items
+    drop = [f for f in LOBBY_FIELDS if f not in fields]
+    return [{k: v for k, v in item.items() if k not in drop} for item in items]
 
 # --- ENDPOINTS ---
 @app.get("/")
 def read_root(): return {"status": "Server OK"}
 
-@app.post("/heartbeat")
-async def heartbeat(user: UserSignal, request: Request):
-    client_ip = user.ip if user.ip else request.client.host 
+@app.get("/metrics")
+async def get_metrics():
+    counts, depth = await call_store(store_gauges)
+    for table, n in counts.items(): state_entries.set(n, table)
+    mm_depth.clear()
+    for game_type, n in depth.items(): mm_depth.set(n, game_type)
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+def check_profiler_token(token: Optional[str]):
+    if not PROFILER_TOKEN or token != PROFILER_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+# Profiler lấy mẫu stack của thread event loop; kết quả ở dạng collapsed stack cho flamegraph
+@app.post("/debug/profile/start")
+async def profile_start(interval: float = PROFILE_INTERVAL, x_profiler_token: Optional[str] = Header(None)):
+    check_profiler_token(x_profiler_token)
+    profiler.start(threading.get_ident(), max(interval, 0.001))
+    return {"status": "running", "interval": max(interval, 0.001)}
+
+@app.post("/debug/profile/stop")
+async def profile_stop(limit: int = 50, x_profiler_token: Optional[str] = Header(None)):
+    check_profiler_token(x_profiler_token)
+    profiler.stop()
+    return Response(profiler.report(limit), media_type="text/plain")
+
+@app.get("/debug/profile")
+async def profile_report(limit: int = 50, x_profiler_token: Optional[str] = Header(None)):
+    check_profiler_token(x_profiler_token)
+    header = f"# running={profiler.running} samples={profiler.sample_count}\n"
+    return Response(header + profiler.report(limit), media_type="text/plain")
+
+# Hot path: tự parse JSON thay vì dựng model Pydantic khi body đã đúng kiểu.
+# Body lệch kiểu (vd. "p2p_port": "1234") đi qua UserSignal như trước để client cũ vẫn được ép kiểu.
+@app.post("/heartbeat", openapi_extra={"requestBody": {
+    "required": True, "content": {"application/json": {"schema": UserSignal.model_json_schema()}}}})
+async def heartbeat(request: Request):
+    try:
+        user = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid heartbeat")
+    if type(user) is dict and type(user.get("username")) is str and type(user.get("p2p_port")) is int \
+            and type(user.get("lobby_state", "menu")) is str and (user.get("ip") is None or type(user["ip"]) is str):
+        username, p2p_port = user["username"], user["p2p_port"]
+        ip, lobby_state = user.get("ip"), user.get("lobby_state", "menu")
+    else:
+        try:
+            signal = UserSignal.model_validate(user)
+        except ValidationError as e:
+            raise RequestValidationError([dict(err, loc=("body", *err["loc"])) for err in e.errors()])
+        username, p2p_port, ip, lobby_state = signal.username, signal.p2p_port, signal.ip, signal.lobby_state
+    client_ip = ip if ip else request.client.host 
     
-    online_users[user.username] = {
-        "ip": client_ip,
-        "port": user.p2p_port,
-        "last_seen": time.time(),
-        "lobby_state": user.lobby_state
-    }
-    cleanup_stale_data()
-    return {"status": "ok"}
+    await call_store(store.touch_user, username, client_ip, p2p_port, lobby_state)
+    return Response(b'{"status":"ok"}', media_type="application/json")
 
+# ETag = epoch-version của lobby: If-None-Match khớp -> 304.
+# since=<epoch>-<version> (lấy từ trường "since" của response trước): chỉ trả các thay đổi sau version đó.
+# Epoch khác (server restart, state tạo lại) hoặc log không còn đủ -> snapshot đầy đủ.
+# fields=username,lobby_state: chỉ lấy các trường cần.
 @app.get("/users")
-async def get_users():
-    cleanup_stale_data()
-    return [
-        {"username": u, "lobby_state": data.get("lobby_state", "menu")} 
-        for u, data in online_users.items()
-    ]
+async def get_users(request: Request, since: Optional[str] = None, fields: Optional[str] = None):
+    version = await call_store(store.lobby_version)
+    as_msgpack = wants_msgpack(request)
+    etag = f'"{store.epoch}-{version}{"-m" if as_msgpack else ""}"'
+    headers = {"ETag": etag, "Vary": "Accept"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    keep = tuple(f for f in LOBBY_FIELDS if f in fields.split(",")) if fields else None
+    token = f"{store.epoch}-{version}"
+    since_version = parse_since(since)
+    if since_version is not None and await call_store(store.lobby_oldest_version) - 1 <= since_version <= version:
+        events = await call_store(lobby_events_since, since_version)
+        # Log đọc theo lô (sqlite: tối đa log_size sự kiện): version/since/ETag là v cuối thực sự trả về,
+        # client còn thiếu thì lần gọi sau lấy tiếp
+        if events:
+            version = events[-1]["v"]
+            token = f"{store.epoch}-{version}"
+            headers["ETag"] = f'"{token}{"-m" if as_msgpack else ""}"'
+        data = {"version": version, "since": token, "changes": project(events, keep)}
+        body, media_type = encode_body(data, as_msgpack)
+    else:
+        key = (since is not None, keep, as_msgpack)
+        cached = users_cache.get(key)
+        if cached and cached[0] == etag:
+            body, media_type = cached[1], cached[2]
+        else:
+            users = project(await call_store(store.lobby_snapshot), keep)
+            data = users if since is None else {"version": version, "since": token, "users": users, "full": True}
+            body, media_type = encode_body(data, as_msgpack)
+            users_cache[key] = (etag, body, media_type)
+    return Response(body, media_type=media_type, headers=headers)
+
+# Lobby dạng push: snapshot khi kết nối, sau đó chỉ gửi batch join/leave/state
+@app.websocket("/lobby/stream")
+async def lobby_stream(ws: WebSocket):
+    await ws.accept()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=LOBBY_QUEUE_LIMIT)
+    lobby_subscribers.add(queue)
+    try:
+        version = await call_store(store.lobby_version)
+        users = await call_store(store.lobby_snapshot)
+        await ws.send_text(json.dumps({"type": "snapshot", "version": version, "users": users}))
+        while True:
+            msg = await queue.get()
+            if msg is None:
+                await ws.close(code=1013)
+                break
+            await ws.send_text(msg)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        lobby_subscribers.discard(queue)
 
 @app.post("/create-room")
 async def create_room(req: CreateRoomRequest, request: Request):
     client_ip = req.ip if req.ip else request.client.host 
     
-    room_id = str(random.randint(10000, 99999))
-    while room_id in rooms: room_id = str(random.randint(10000, 99999))
-
-    rooms[room_id] = {
-        "host_username": req.username,
-        "host_ip": client_ip, 
-        "host_port": req.p2p_port,
-        "game_type": req.game_type, 
-        "created_at": time.time()
-    }
+    try:
+        room_id = await call_store(store.create_room, {
+            "host_username": req.username,
+            "host_ip": client_ip, 
+            "host_port": req.p2p_port,
+            "game_type": req.game_type, 
+            "created_at": time.time()
+        })
+    except RoomsFull:
+        raise HTTPException(status_code=503, detail="No free room id")
     print(f"[ROOM] {room_id} ({req.game_type}) by {req.username}")
     return {"room_id": room_id}
 
 @app.post("/join-room")
-async def join_room(req: JoinRoomRequest):
-    room = rooms.get(req.room_id)
+async def join_room(req: JoinRoomRequest, request: Request):
+    room = await call_store(store.join_room, req.room_id, req.username)
     if not room: raise HTTPException(status_code=404, detail="Room not found")
     
-    return {
+    resp = {
         "status": "found",
         "host_ip": room["host_ip"], 
         "host_port": room["host_port"],
         "host_username": room["host_username"],
         "game_type": room.get("game_type", "chess") 
     }
+    if req.relay:
+        if not RELAY_PORT: raise HTTPException(status_code=503, detail="Relay disabled")
+        if req.username == room["host_username"]:
+            raise HTTPException(status_code=409, detail="Host cannot request relay")
+        # Chỉ người đang giữ chỗ khách mới được cấp token, người khác biết room_id cũng không chen vào được
+        if room["guest_username"] != req.username:
+            raise HTTPException(status_code=409, detail="Room already taken")
+        endpoint = {"host": RELAY_PUBLIC_HOST or request.url.hostname, "port": RELAY_PORT}
+        # Host nhận token qua /relay/offers, khách nhận ngay trong response
+        await push_mail("relay", room["host_username"], dict(
+            endpoint, token=relay.issue_token(req.room_id, "host"),
+            room_id=req.room_id, guest_username=req.username, timestamp=time.time()))
+        resp["relay"] = dict(endpoint, token=relay.issue_token(req.room_id, "guest"))
+    return encode_response(resp, request)
+
+# Duyệt phòng đang mở (chưa có người vào), phân trang bằng cursor = seq của phòng cuối trang
+@app.get("/rooms")
+async def list_rooms(game_type: Optional[str] = None, host: Optional[str] = None, cursor: int = 0, limit: int = 20):
+    limit = max(1, min(limit, ROOMS_PAGE_MAX))
+    page, next_cursor = await call_store(store.list_rooms, game_type, host, cursor, limit)
+    return {"rooms": page, "next_cursor": next_cursor}
+
+# --- MATCHMAKING ---
+@app.post("/matchmaking/enqueue")
+async def matchmaking_enqueue(req: MatchRequest, request: Request):
+    client_ip = req.ip if req.ip else request.client.host
+    bucket = req.rating // MM_RATING_BUCKET
+    await call_store(store.mm_enqueue, {
+        "username": req.username,
+        "game_type": req.game_type,
+        "region": req.region,
+        "bucket": bucket,
+        "rating": req.rating,
+        "ip": client_ip,
+        "port": req.p2p_port,
+        "enqueued_at": time.time()
+    })
+    return {"status": "queued", "bucket": bucket}
+
+@app.post("/matchmaking/cancel/{username}")
+async def matchmaking_cancel(username: str):
+    return {"status": "cancelled" if await call_store(store.mm_cancel, username) else "none"}
+
+# wait > 0: long-poll tới khi ghép xong; kết quả có host_ip/host_port giống /join-room
+@app.get("/matchmaking/status/{username}")
+async def matchmaking_status(username: str, wait: float = 0):
+    result = await poll_mail("match", username, wait)
+    if result: return result
+    return {"status": "waiting" if await call_store(store.mm_ticket, username) else "none"}
+
+@app.get("/matchmaking/stats")
+async def matchmaking_stats():
+    waits = sorted(match_waits)
+    pct = lambda p: round(waits[min(len(waits) - 1, int(p * len(waits)))], 3) if waits else None
+    return {
+        "queue_depth": await call_store(store.mm_depth),
+        "matches_total": matches_total,
+        "time_to_match": {"p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99), "samples": len(waits)},
+    }
+
+# --- RELAY ---
+# Host long-poll để biết khách yêu cầu relay, rồi mở TCP tới relay với token nhận được
+@app.get("/relay/offers/{username}")
+async def relay_offers(username: str, wait: float = 0):
+    offer = await poll_mail("relay", username, wait)
+    return offer or {"status": "none"}
+
+@app.get("/relay/stats")
+async def relay_stats(limit: int = 100):
+    return relay.stats(limit)
 
 @app.post("/send-invite")
 async def send_invite(req: InviteRequest):
-    if req.target not in online_users:
+    if await call_store(store.get_user, req.target) is None:
         raise HTTPException(status_code=404, detail="User offline")
     
-    invites[req.target] = {
+    # Mời lại cùng người thì thay lời mời cũ, không đè lời mời của người khác
+    invite_events.inc("sent")
+    await push_mail("invite", req.target, {
         "from": req.challenger,
         "room_id": req.room_id,
         "game_type": req.game_type, 
         "timestamp": time.time()
-    }
+    }, replace_from=req.challenger)
     return {"status": "sent"}
 
+# wait > 0: long-poll, giữ request tới khi có lời mời hoặc hết thời gian
 @app.get("/check-invite/{username}")
-async def check_invite(username: str):
-    invite = invites.get(username)
-    if invite:
-        if time.time() - invite["timestamp"] < 10:
-            del invites[username]
-            return invite
-        else:
-            del invites[username]
-    return {"status": "none"}
+async def check_invite(username: str, wait: float = 0):
+    invite = await poll_mail("invite", username, wait, mark_delivered=True)
+    if invite: invite_events.inc("delivered")
+    return invite or {"status": "none"}
+
+async def answer_invite(username: str, room_id: str, status: str):
+    invite = await call_store(store.resolve_invite, username, room_id)
+    if not invite:
+        invite_events.inc("answer_expired")
+        return {"status": "expired"}
+    invite_events.inc(status)
+    await push_mail("reply", invite["from"], {
+        "status": status,
+        "by": username,
+        "room_id": room_id,
+        "game_type": invite["game_type"],
+        "timestamp": time.time()
+    })
+    return {"status": status}
 
-# API chấp nhận lời mời (Optional)
 @app.post("/accept-invite/{username}/{room_id}")
 async def accept_invite(username: str, room_id: str):
-    return {"status": "accepted"}
+    return await answer_invite(username, room_id, "accepted")
+
+@app.post("/decline-invite/{username}/{room_id}")
+async def decline_invite(username: str, room_id: str):
+    return await answer_invite(username, room_id, "declined")
+
+# Người mời chờ phản hồi (accept/decline) theo cùng cơ chế long-poll
+@app.get("/invite-replies/{username}")
+async def invite_replies_poll(username: str, wait: float = 0):
+    reply = await poll_mail("reply", username, wait)
+    return reply or {"status": "none"}
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 10000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # Không dùng WEB_CONCURRENCY: nhiều nền tảng host tự đặt biến này
+    workers = int(os.environ.get("SIGNALING_WORKERS", 1))
+    if workers > 1 and not store.shared:
+        print("[WARN] SIGNALING_WORKERS > 1 cần STATE_BACKEND=sqlite, chạy 1 worker")
+        workers = 1
+    if workers > 1 and RELAY_PORT and not os.environ.get("RELAY_SECRET"):
+        # Mỗi worker tự sinh secret ngẫu nhiên thì token do worker này cấp bị relay ở worker khác từ chối
+        raise SystemExit("[ERROR] RELAY_PORT với SIGNALING_WORKERS > 1 cần RELAY_SECRET chung cho mọi worker")
+    uvicorn.run("server:app", host="0.0.0.0", port=port, workers=workers)
\ No newline at end of file
@@ -0,0 +1,800 @@
+# store.py - Nơi lưu state của signaling server (users, rooms, invites, lobby log)
+#
+# MemoryStore: dict trong tiến trình, nhanh nhất nhưng chỉ chạy được 1 worker.
+# SqliteStore: file SQLite (WAL) dùng chung, nhiều worker/tiến trình trên cùng một máy cùng đọc ghi.
+import json
+import time
+import heapq
+import random
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+# room_id 5 chữ số: 10000..99999. Cấp theo hoán vị n -> (n * STRIDE + offset) % SPACE,
+# STRIDE nguyên tố cùng nhau với SPACE nên 90000 lần cấp đầu không bao giờ trùng;
+# sau đó dùng lại ID đã giải phóng theo thứ tự FIFO (free-list).
+ROOM_ID_BASE = 10000
+ROOM_ID_SPACE = 90000
+ROOM_ID_STRIDE = 48271
+# Nới rating chỉ đổi theo bậc widen_after giây: nhóm không có vé mới được quét lại tối đa mỗi giây một lần
+WIDEN_SCAN_INTERVAL = 1.0
+
+
+class RoomsFull(Exception):
+    """Hết room_id trống."""
+
+
+class StoreBusy(Exception):
+    """Không lấy được write lock trong busy_timeout (worker khác đang ghi)."""
+
+
+def permuted_room_id(n: int, offset: int) -> str:
+    return str(ROOM_ID_BASE + (n * ROOM_ID_STRIDE + offset) % ROOM_ID_SPACE)
+
+
+def pair_tickets(tickets: List[Dict], now: float, widen_after: float) -> List[Tuple[Dict, Dict]]:
+    """Ghép cặp vé cùng game_type/region, đã sắp theo (bucket, enqueued_at).
+
+    Trước hết ghép trong cùng bucket theo FIFO; vé lẻ còn lại được ghép với bucket
+    lân cận, mỗi widen_after giây chờ (tính theo người chờ lâu hơn) nới thêm 1 bucket.
+    Người vào hàng trước làm host (phần tử đầu của cặp).
+    """
+    pairs = []
+    singles = []
+    i = 0
+    while i < len(tickets):
+        j = i
+        while j < len(tickets) and tickets[j]["bucket"] == tickets[i]["bucket"]: j += 1
+        for k in range(i, j - 1, 2): pairs.append((tickets[k], tickets[k + 1]))
+        if (j - i) % 2: singles.append(tickets[j - 1])
+        i = j
+    i = 0
+    while i < len(singles) - 1:
+        a, b = singles[i], singles[i + 1]
+        allowed = int((now - min(a["enqueued_at"], b["enqueued_at"])) // widen_after)
+        if b["bucket"] - a["bucket"] <= allowed:
+            pairs.append((a, b) if a["enqueued_at"] <= b["enqueued_at"] else (b, a))
+            i += 2
+        else:
+            i += 1
+    return pairs
+
+
+class StateStore(ABC):
+    """Giao diện chung. Mọi method đồng bộ và nguyên tử với các worker khác."""
+    shared = False  # True nếu worker khác cũng ghi vào store này
+    epoch = 0       # đổi khi state được tạo lại, để version cũ không bị hiểu nhầm
+
+    def __init__(self, user_ttl: float, room_ttl: float, mail_ttl: float,
+                 mail_limit: int, log_size: int, ticket_ttl: float = 120,
+                 mail_ttls: Optional[Dict[str, float]] = None, answer_ttl: Optional[float] = None):
+        self.user_ttl = user_ttl
+        self.room_ttl = room_ttl
+        self.mail_ttl = mail_ttl
+        self.mail_ttls = mail_ttls or {}  # TTL riêng theo loại mail (match, relay...), mặc định mail_ttl
+        # Lời mời đã giao (take_mail mark_delivered) được giữ thêm answer_ttl để người chơi kịp accept/decline
+        self.answer_ttl = answer_ttl if answer_ttl is not None else mail_ttl
+        self.mail_limit = mail_limit
+        self.log_size = log_size
+        self.ticket_ttl = ticket_ttl
+        self.evicted: Dict[str, int] = {}  # số entry bị expire() xoá theo loại (user, room, invite, ...)
+
+    def _mail_expiry(self, kind: str, item: Dict) -> float:
+        return item["timestamp"] + self.mail_ttls.get(kind, self.mail_ttl)
+
+    def _count_evicted(self, kind: str, n: int = 1):
+        if n: self.evicted[kind] = self.evicted.get(kind, 0) + n
+
+    # users / lobby
+    @abstractmethod
+    def touch_user(self, username: str, ip: str, port: int, lobby_state: str) -> None: ...
+    @abstractmethod
+    def get_user(self, username: str) -> Optional[Dict]: ...
+    @abstractmethod
+    def lobby_snapshot(self) -> List[Dict]: ...
+    @abstractmethod
+    def lobby_version(self) -> int: ...
+    @abstractmethod
+    def lobby_log_since(self, version: int) -> List[Dict]: ...
+    @abstractmethod
+    def lobby_oldest_version(self) -> int:
+        """v nhỏ nhất còn trong log (lobby_version() + 1 nếu log rỗng)."""
+    # rooms
+    @abstractmethod
+    def create_room(self, room: Dict) -> str: ...
+    @abstractmethod
+    def get_room(self, room_id: str) -> Optional[Dict]: ...
+    @abstractmethod
+    def join_room(self, room_id: str, username: str) -> Optional[Dict]:
+        """Như get_room, người vào đầu tiên (khác host) chiếm chỗ và phòng rời danh sách mở."""
+    @abstractmethod
+    def list_rooms(self, game_type: Optional[str], host: Optional[str], cursor: int, limit: int) -> Tuple[List[Dict], Optional[int]]:
+        """Phòng đang mở theo thứ tự tạo, seq > cursor. Trả về (rooms, next_cursor)."""
+    # invites / replies
+    @abstractmethod
+    def push_mail(self, kind: str, username: str, item: Dict, replace_from: Optional[str] = None) -> Dict: ...
+    @abstractmethod
+    def take_mail(self, kind: str, username: str, mark_delivered: bool = False) -> Optional[Dict]: ...
+    @abstractmethod
+    def resolve_invite(self, username: str, room_id: str) -> Optional[Dict]: ...
+    # matchmaking: vé gồm username, game_type, region, bucket, rating, ip, port, enqueued_at
+    @abstractmethod
+    def mm_enqueue(self, ticket: Dict) -> None: ...
+    @abstractmethod
+    def mm_cancel(self, username: str) -> bool: ...
+    @abstractmethod
+    def mm_ticket(self, username: str) -> Optional[Dict]: ...
+    @abstractmethod
+    def mm_match(self, widen_after: float) -> List[Tuple[Dict, Dict]]:
+        """Ghép cặp và xoá các vé đã ghép khỏi hàng đợi."""
+    @abstractmethod
+    def mm_depth(self) -> Dict[str, int]: ...
+    # expiry
+    @abstractmethod
+    def expire(self) -> List[str]:
+        """Xoá entry hết hạn, trả về các username vừa offline."""
+    @abstractmethod
+    def counts(self) -> Dict[str, int]: ...
+
+
+class MemoryStore(StateStore):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.online_users: Dict[str, Dict] = {}
+        self.rooms: Dict[str, Dict] = {}
+        self.room_offset = random.randrange(ROOM_ID_SPACE)
+        self.room_count = 0
+        self.free_room_ids: Deque[str] = deque()
+        # Index phụ: game_type (và "*" = tất cả) -> danh sách seq tăng dần của phòng đang mở
+        self.open_rooms: Dict[str, List[int]] = {"*": []}
+        self.room_by_seq: Dict[int, str] = {}
+        self.rooms_by_host: Dict[str, Set[str]] = {}
+        self.invites: Dict[str, Deque[Dict]] = {}        # target -> hàng đợi lời mời
+        self.invite_replies: Dict[str, Deque[Dict]] = {}  # challenger -> phản hồi accept/decline
+        self.match_results: Dict[str, Deque[Dict]] = {}   # username -> kết quả ghép trận
+        self.relay_offers: Dict[str, Deque[Dict]] = {}    # host -> token relay khi khách không P2P được
+        self.mailboxes = {
+            "invite": self.invites, "reply": self.invite_replies,
+            "match": self.match_results, "relay": self.relay_offers,
+        }
+        # Matchmaking: vé theo username, hàng đợi FIFO theo (game_type, region, bucket).
+        # Huỷ/vào lại chỉ thay vé trong mm_tickets; vé cũ trong deque bị bỏ qua khi pop.
+        self.mm_tickets: Dict[str, Dict] = {}
+        self.mm_buckets: Dict[Tuple[str, str, int], Deque[Dict]] = {}
+        self.mm_groups: Dict[Tuple[str, str], Set[int]] = {}  # (game_type, region) -> bucket đang có vé
+        self.mm_dirty: Set[Tuple[str, str, int]] = set()
+        self.mm_widened_at = 0.0
+        self.mm_depth_by_game: Dict[str, int] = {}
+        self.mail_seq = 0
+        # Log sự kiện lobby: mỗi join/leave/state tăng version
+        self.version = 0
+        self.epoch = random.getrandbits(31)
+        self.lobby_log: Deque[Dict] = deque(maxlen=self.log_size)
+        # Min-heap (deadline, kind, key): mỗi user/room/hàng đợi có một entry, kiểm tra lười khi pop
+        self.expiry_heap: List[Tuple[float, str, str]] = []
+
+    def _lobby_event(self, kind: str, username: str, lobby_state: Optional[str] = None):
+        self.version += 1
+        event = {"type": kind, "username": username, "v": self.version}
+        if lobby_state is not None: event["lobby_state"] = lobby_state
+        self.lobby_log.append(event)
+
+    def _schedule(self, deadline: float, kind: str, key: str):
+        heapq.heappush(self.expiry_heap, (deadline, kind, key))
+
+    def touch_user(self, username, ip, port, lobby_state):
+        now = time.time()
+        prev = self.online_users.get(username)
+        self.online_users[username] = {
+            "ip": ip,
+            "port": port,
+            "last_seen": now,
+            "lobby_state": lobby_state
+        }
+        if prev is None:
+            self._schedule(now + self.user_ttl, "user", username)
+            self._lobby_event("join", username, lobby_state)
+        elif prev.get("lobby_state") != lobby_state:
+            self._lobby_event("state", username, lobby_state)
+
+    def get_user(self, username):
+        return self.online_users.get(username)
+
+    def lobby_snapshot(self):
+        return [
+            {"username": u, "lobby_state": data.get("lobby_state", "menu")}
+            for u, data in self.online_users.items()
+        ]
+
+    def lobby_version(self):
+        return self.version
+
+    def lobby_oldest_version(self):
+        return self.lobby_log[0]["v"] if self.lobby_log else self.version + 1
+
+    def lobby_log_since(self, version):
+        events = []
+        for event in reversed(self.lobby_log):
+            if event["v"] <= version: break
+            events.append(event)
+        events.reverse()
+        return events
+
+    def _open_keys(self, room: Dict):
+        return ("*", room["game_type"])
+
+    def _close_room(self, room: Dict):
+        # Bỏ phòng khỏi index phòng mở
+        seq = room["seq"]
+        for key in self._open_keys(room):
+            seqs = self.open_rooms.get(key)
+            if not seqs: continue
+            i = bisect_left(seqs, seq)
+            if i < len(seqs) and seqs[i] == seq: del seqs[i]
+            if not seqs and key != "*": del self.open_rooms[key]
+        self.room_by_seq.pop(seq, None)
+
+    def create_room(self, room):
+        if self.room_count < ROOM_ID_SPACE:
+            room_id = permuted_room_id(self.room_count, self.room_offset)
+        elif self.free_room_ids:
+            room_id = self.free_room_ids.popleft()
+        else:
+            raise RoomsFull()
+        seq = self.room_count = self.room_count + 1
+        room = dict(room, seq=seq, guest_username=None)
+        self.rooms[room_id] = room
+        # seq tăng dần nên append vẫn giữ danh sách đã sắp xếp
+        for key in self._open_keys(room): self.open_rooms.setdefault(key, []).append(seq)
+        self.room_by_seq[seq] = room_id
+        self.rooms_by_host.setdefault(room["host_username"], set()).add(room_id)
+        self._schedule(room["created_at"] + self.room_ttl, "room", room_id)
+        return room_id
+
+    def get_room(self, room_id):
+        return self.rooms.get(room_id)
+
+    def join_room(self, room_id, username):
+        room = self.rooms.get(room_id)
+        if room and room["guest_username"] is None and username != room["host_username"]:
+            room["guest_username"] = username
+            self._close_room(room)
+        return room
+
+    def _room_summary(self, room_id: str, room: Dict) -> Dict:
+        return {
+            "room_id": room_id,
+            "host_username": room["host_username"],
+            "game_type": room["game_type"],
+            "created_at": room["created_at"],
+        }
+
+    def list_rooms(self, game_type, host, cursor, limit):
+        if host is not None:
+            # Mỗi host chỉ có vài phòng: lọc thẳng trên index host
+            found = [
+                (room["seq"], rid, room) for rid in self.rooms_by_host.get(host, ())
+                for room in (self.rooms[rid],)
+                if room["guest_username"] is None and room["seq"] > cursor
+                and (game_type is None or room["game_type"] == game_type)
+            ]
+            found.sort()
+            page = found[:limit]
+        else:
+            seqs = self.open_rooms.get(game_type or "*", [])
+            i = bisect_right(seqs, cursor)
+            page = []
+            for seq in seqs[i:i + limit]:
+                rid = self.room_by_seq[seq]
+                page.append((seq, rid, self.rooms[rid]))
+        next_cursor = page[-1][0] if len(page) == limit else None
+        return [self._room_summary(rid, room) for _, rid, room in page], next_cursor
+
+    def push_mail(self, kind, username, item, replace_from=None):
+        box = self.mailboxes[kind]
+        queue = box.get(username)
+        if queue and replace_from is not None:
+            for old in [i for i in queue if i.get("from") == replace_from]: queue.remove(old)
+        expires_at = self._mail_expiry(kind, item)
+        if not queue:
+            queue = box[username] = deque(maxlen=self.mail_limit)
+            self._schedule(expires_at, kind, username)
+        self.mail_seq += 1
+        item = dict(item, id=self.mail_seq)
+        queue.append(dict(item, expires_at=expires_at))
+        return item
+
+    @staticmethod
+    def _public(item: Dict) -> Dict:
+        return {k: v for k, v in item.items() if k not in ("delivered", "expires_at")}
+
+    def take_mail(self, kind, username, mark_delivered=False):
+        # Lấy phần tử còn hạn đầu tiên; lời mời chỉ được đánh dấu đã giao, giữ lại cho accept
+        queue = self.mailboxes[kind].get(username)
+        if not queue: return None
+        now = time.time()
+        for item in queue:
+            if now >= item["expires_at"] or item.get("delivered"): continue
+            if not mark_delivered:
+                queue.remove(item)
+                if not queue: del self.mailboxes[kind][username]
+            else:
+                item["delivered"] = True
+                item["expires_at"] = max(item["expires_at"], now + self.answer_ttl)
+            return self._public(item)
+        return None
+
+    def resolve_invite(self, username, room_id):
+        queue = self.invites.get(username)
+        if not queue: return None
+        for item in queue:
+            if item["room_id"] == room_id and time.time() < item["expires_at"]:
+                queue.remove(item)
+                if not queue: del self.invites[username]
+                return self._public(item)
+        return None
+
+    def _current_deadline(self, kind: str, key: str) -> Optional[float]:
+        # Deadline thật của entry, None nếu entry đã bị xoá
+        if kind == "user":
+            data = self.online_users.get(key)
+            return data["last_seen"] + self.user_ttl if data else None
+        if kind == "room":
+            room = self.rooms.get(key)
+            return room["created_at"] + self.room_ttl if room else None
+        if kind == "mm":
+            ticket = self.mm_tickets.get(key)
+            return ticket["enqueued_at"] + self.ticket_ttl if ticket else None
+        queue = self.mailboxes[kind].get(key)
+        return min(item["expires_at"] for item in queue) if queue else None
+
+    def expire(self):
+        # Chỉ pop các entry đã tới hạn: O(k log n) với k entry hết hạn
+        now = time.time()
+        left = []
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            _, kind, key = heapq.heappop(heap)
+            deadline = self._current_deadline(kind, key)
+            if deadline is None: continue
+            if deadline > now:
+                # Đã được làm mới (heartbeat, invite mới) -> lên lịch lại
+                self._schedule(deadline, kind, key)
+                continue
+            if kind == "user":
+                del self.online_users[key]
+                self._lobby_event("leave", key)
+                left.append(key)
+                self._count_evicted("user")
+            elif kind == "room":
+                room = self.rooms.pop(key)
+                self._close_room(room)
+                host_rooms = self.rooms_by_host.get(room["host_username"])
+                if host_rooms is not None:
+                    host_rooms.discard(key)
+                    if not host_rooms: del self.rooms_by_host[room["host_username"]]
+                self.free_room_ids.append(key)
+                self._count_evicted("room")
+            elif kind == "mm":
+                self.mm_cancel(key)
+                self._count_evicted("mm")
+            else:
+                # Hàng đợi ngắn (tối đa mail_limit): lọc hết phần tử đã hết hạn
+                queue = self.mailboxes[kind][key]
+                live = [item for item in queue if item["expires_at"] > now]
+                self._count_evicted(kind, len(queue) - len(live))
+                if live:
+                    queue.clear()
+                    queue.extend(live)
+                    self._schedule(min(item["expires_at"] for item in live), kind, key)
+                else:
+                    del self.mailboxes[kind][key]
+        return left
+
+    def _mm_bucket_key(self, ticket: Dict) -> Tuple[str, str, int]:
+        return (ticket["game_type"], ticket["region"], ticket["bucket"])
+
+    def _mm_drop(self, ticket: Dict):
+        del self.mm_tickets[ticket["username"]]
+        self.mm_depth_by_game[ticket["game_type"]] -= 1
+        if not self.mm_depth_by_game[ticket["game_type"]]: del self.mm_depth_by_game[ticket["game_type"]]
+
+    def _mm_del_bucket(self, key: Tuple[str, str, int]):
+        del self.mm_buckets[key]
+        buckets = self.mm_groups[key[:2]]
+        buckets.discard(key[2])
+        if not buckets: del self.mm_groups[key[:2]]
+
+    def _mm_pop(self, queue: Deque[Dict]) -> Optional[Dict]:
+        while queue:
+            ticket = queue.popleft()
+            if self.mm_tickets.get(ticket["username"]) is ticket: return ticket
+        return None
+
+    def mm_enqueue(self, ticket):
+        old = self.mm_tickets.get(ticket["username"])
+        if old is not None:
+            self._mm_drop(old)
+            self.mm_dirty.add(self._mm_bucket_key(old))
+        else:
+            self._schedule(ticket["enqueued_at"] + self.ticket_ttl, "mm", ticket["username"])
+        ticket = dict(ticket)
+        self.mm_tickets[ticket["username"]] = ticket
+        self.mm_depth_by_game[ticket["game_type"]] = self.mm_depth_by_game.get(ticket["game_type"], 0) + 1
+        key = self._mm_bucket_key(ticket)
+        if key not in self.mm_buckets:
+            self.mm_buckets[key] = deque()
+            self.mm_groups.setdefault(key[:2], set()).add(key[2])
+        self.mm_buckets[key].append(ticket)
+        self.mm_dirty.add(key)
+
+    def mm_cancel(self, username):
+        ticket = self.mm_tickets.get(username)
+        if ticket is None: return False
+        self._mm_drop(ticket)
+        self.mm_dirty.add(self._mm_bucket_key(ticket))
+        return True
+
+    def mm_ticket(self, username):
+        return self.mm_tickets.get(username)
+
+    def mm_match(self, widen_after):
+        # Chỉ ghép trong các bucket có thay đổi từ lần trước: O(vé mới), không quét cả hàng đợi
+        pairs = []
+        touched = {key[:2] for key in self.mm_dirty}
+        for key in self.mm_dirty:
+            queue = self.mm_buckets.get(key)
+            if queue is None: continue
+            while True:
+                a = self._mm_pop(queue)
+                if a is None: break
+                b = self._mm_pop(queue)
+                if b is None:
+                    queue.appendleft(a)
+                    break
+                pairs.append((a, b))
+            if not queue: self._mm_del_bucket(key)
+        self.mm_dirty.clear()
+        # Mỗi bucket còn đúng 1 vé: nới rating sang bucket lân cận, trong nhóm vừa có thay đổi
+        # hoặc mọi nhóm nếu đã tới lượt quét định kỳ
+        now = time.time()
+        if now - self.mm_widened_at >= WIDEN_SCAN_INTERVAL:
+            self.mm_widened_at = now
+            touched = self.mm_groups
+        for group in list(touched):
+            buckets = self.mm_groups.get(group)
+            if not buckets or len(buckets) < 2: continue
+            singles = [self.mm_buckets[group + (b,)][0] for b in sorted(buckets)]
+            for a, b in pair_tickets(singles, now, widen_after):
+                for t in (a, b): self._mm_del_bucket(self._mm_bucket_key(t))
+                pairs.append((a, b))
+        for a, b in pairs:
+            self._mm_drop(a)
+            self._mm_drop(b)
+        return pairs
+
+    def mm_depth(self):
+        return dict(self.mm_depth_by_game)
+
+    def counts(self):
+        return {
+            "users": len(self.online_users),
+            "rooms": len(self.rooms),
+            "invites": sum(len(q) for q in self.invites.values()),
+        }
+
+
+SCHEMA_VERSION = 5
+BUSY_TIMEOUT_MS = 1000      # chờ write lock tối đa; quá hạn -> StoreBusy thay vì treo request
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY, ip TEXT, port INTEGER, lobby_state TEXT,
+    last_seen REAL, expires_at REAL);
+CREATE INDEX IF NOT EXISTS users_expires ON users(expires_at);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY, seq INTEGER UNIQUE, host_username TEXT, host_ip TEXT, host_port INTEGER,
+    game_type TEXT, guest_username TEXT, created_at REAL, expires_at REAL);
+CREATE INDEX IF NOT EXISTS rooms_expires ON rooms(expires_at);
+CREATE INDEX IF NOT EXISTS rooms_open ON rooms(seq) WHERE guest_username IS NULL;
+CREATE INDEX IF NOT EXISTS rooms_open_game ON rooms(game_type, seq) WHERE guest_username IS NULL;
+CREATE INDEX IF NOT EXISTS rooms_host ON rooms(host_username, seq);
+CREATE TABLE IF NOT EXISTS room_free (room_id TEXT PRIMARY KEY, freed_at REAL);
+CREATE INDEX IF NOT EXISTS room_free_order ON room_free(freed_at);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS mail (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, username TEXT, sender TEXT,
+    room_id TEXT, body TEXT, expires_at REAL, delivered INTEGER DEFAULT 0);
+CREATE INDEX IF NOT EXISTS mail_owner ON mail(kind, username, id);
+CREATE INDEX IF NOT EXISTS mail_expires ON mail(expires_at);
+CREATE TABLE IF NOT EXISTS mm_queue (
+    username TEXT PRIMARY KEY, game_type TEXT, region TEXT, bucket INTEGER, rating INTEGER,
+    ip TEXT, port INTEGER, enqueued_at REAL);
+CREATE INDEX IF NOT EXISTS mm_order ON mm_queue(game_type, region, bucket, enqueued_at);
+CREATE INDEX IF NOT EXISTS mm_expires ON mm_queue(enqueued_at);
+CREATE TABLE IF NOT EXISTS mm_dirty (
+    game_type TEXT, region TEXT, bucket INTEGER, PRIMARY KEY (game_type, region, bucket)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lobby_log (
+    v INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT, username TEXT, lobby_state TEXT);
+"""
+
+
+class SqliteStore(StateStore):
+    """Mọi method chặn (I/O, chờ lock): server gọi qua thread pool, mỗi thread một connection riêng."""
+    shared = True
+
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.local = threading.local()
+        # Các thread trong cùng worker xếp hàng ở lock này; chỉ các worker tranh nhau write lock của SQLite
+        # (busy handler của SQLite ngủ rồi thử lại, nhiều người chờ thì có người bị bỏ đói)
+        self.write_lock = threading.Lock()
+        self.mm_widened_at = 0.0
+        with self._tx() as db:
+            # State chỉ sống vài phút: schema cũ thì tạo lại từ đầu
+            if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                for table in ("users", "rooms", "room_free", "meta", "mail", "mm_queue", "mm_dirty", "lobby_log"):
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                for stmt in SCHEMA.split(";"):
+                    if stmt.strip(): db.execute(stmt)
+                db.execute("INSERT INTO meta VALUES ('room_count', 0), ('room_offset', ?), ('epoch', ?)",
+                           (random.randrange(ROOM_ID_SPACE), random.getrandbits(31)))
+                db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self.epoch = db.execute("SELECT value FROM meta WHERE key='epoch'").fetchone()[0]
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "db", None)
+        if conn is None:
+            conn = self.local.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        # BEGIN IMMEDIATE: lấy write lock ngay, tránh 2 worker cùng đọc rồi cùng ghi
+        if not self.write_lock.acquire(timeout=BUSY_TIMEOUT_MS / 1000): raise StoreBusy("write lock")
+        try:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                raise StoreBusy(str(e)) from e
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+        finally:
+            self.write_lock.release()
+
+    def touch_user(self, username, ip, port, lobby_state):
+        now = time.time()
+        with self._tx() as db:
+            prev = db.execute(
+                "SELECT lobby_state FROM users WHERE username=? AND expires_at>?", (username, now)).fetchone()
+            db.execute(
+                "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(username) DO UPDATE SET "
+                "ip=excluded.ip, port=excluded.port, lobby_state=excluded.lobby_state, "
+                "last_seen=excluded.last_seen, expires_at=excluded.expires_at",
+                (username, ip, port, lobby_state, now, now + self.user_ttl))
+            if prev is None:
+                db.execute("INSERT INTO lobby_log (type, username, lobby_state) VALUES ('join', ?, ?)", (username, lobby_state))
+            elif prev["lobby_state"] != lobby_state:
+                db.execute("INSERT INTO lobby_log (type, username, lobby_state) VALUES ('state', ?, ?)", (username, lobby_state))
+
+    def get_user(self, username):
+        row = self.db.execute(
+            "SELECT ip, port, last_seen, lobby_state FROM users WHERE username=? AND expires_at>?",
+            (username, time.time())).fetchone()
+        return dict(row) if row else None
+
+    def lobby_snapshot(self):
+        rows = self.db.execute("SELECT username, lobby_state FROM users WHERE expires_at>?", (time.time(),))
+        return [dict(r) for r in rows]
+
+    def lobby_version(self):
+        return self.db.execute("SELECT COALESCE(MAX(v), 0) FROM lobby_log").fetchone()[0]
+
+    def lobby_oldest_version(self):
+        return self.db.execute(
+            "SELECT COALESCE(MIN(v), (SELECT COALESCE(MAX(seq), 0) + 1 FROM sqlite_sequence WHERE name='lobby_log')) "
+            "FROM lobby_log").fetchone()[0]
+
+    def lobby_log_since(self, version):
+        rows = self.db.execute(
+            "SELECT v, type, username, lobby_state FROM lobby_log WHERE v>? ORDER BY v LIMIT ?",
+            (version, self.log_size))
+        events = []
+        for r in rows:
+            event = {"type": r["type"], "username": r["username"], "v": r["v"]}
+            if r["lobby_state"] is not None: event["lobby_state"] = r["lobby_state"]
+            events.append(event)
+        return events
+
+    def create_room(self, room):
+        # Bộ đếm và free-list nằm trong cùng transaction -> các worker không cấp trùng
+        with self._tx() as db:
+            meta = dict(db.execute("SELECT key, value FROM meta").fetchall())
+            count = meta["room_count"]
+            if count < ROOM_ID_SPACE:
+                room_id = permuted_room_id(count, meta["room_offset"])
+            else:
+                row = db.execute("SELECT room_id FROM room_free ORDER BY freed_at LIMIT 1").fetchone()
+                if row is None: raise RoomsFull()
+                room_id = row[0]
+                db.execute("DELETE FROM room_free WHERE room_id=?", (room_id,))
+            seq = count + 1
+            db.execute("UPDATE meta SET value=? WHERE key='room_count'", (seq,))
+            db.execute(
+                "INSERT INTO rooms VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?)",
+                (room_id, seq, room["host_username"], room["host_ip"], room["host_port"],
+                 room["game_type"], room["created_at"], room["created_at"] + self.room_ttl))
+        return room_id
+
+    def get_room(self, room_id):
+        row = self.db.execute(
+            "SELECT host_username, host_ip, host_port, game_type, guest_username, created_at, seq FROM rooms "
+            "WHERE room_id=? AND expires_at>?", (room_id, time.time())).fetchone()
+        return dict(row) if row else None
+
+    def join_room(self, room_id, username):
+        with self._tx() as db:
+            db.execute(
+                "UPDATE rooms SET guest_username=? WHERE room_id=? AND guest_username IS NULL AND host_username<>?",
+                (username, room_id, username))
+            return self.get_room(room_id)
+
+    def list_rooms(self, game_type, host, cursor, limit):
+        sql = "SELECT room_id, host_username, game_type, created_at, seq FROM rooms " \
+              "WHERE guest_username IS NULL AND seq>? AND expires_at>?"
+        args: list = [cursor, time.time()]
+        if game_type is not None:
+            sql += " AND game_type=?"
+            args.append(game_type)
+        if host is not None:
+            sql += " AND host_username=?"
+            args.append(host)
+        rows = self.db.execute(sql + " ORDER BY seq LIMIT ?", args + [limit]).fetchall()
+        next_cursor = rows[-1]["seq"] if len(rows) == limit else None
+        return [{k: r[k] for k in ("room_id", "host_username", "game_type", "created_at")} for r in rows], next_cursor
+
+    def push_mail(self, kind, username, item, replace_from=None):
+        with self._tx() as db:
+            if replace_from is not None:
+                db.execute("DELETE FROM mail WHERE kind=? AND username=? AND sender=?", (kind, username, replace_from))
+            cur = db.execute(
+                "INSERT INTO mail (kind, username, sender, room_id, body, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, username, item.get("from"), item.get("room_id"), json.dumps(item),
+                 self._mail_expiry(kind, item)))
+            # Giới hạn hàng đợi: bỏ các phần tử cũ nhất
+            db.execute(
+                "DELETE FROM mail WHERE kind=? AND username=? AND id NOT IN "
+                "(SELECT id FROM mail WHERE kind=? AND username=? ORDER BY id DESC LIMIT ?)",
+                (kind, username, kind, username, self.mail_limit))
+        return dict(item, id=cur.lastrowid)
+
+    def take_mail(self, kind, username, mark_delivered=False):
+        # Long-poll gọi lại mỗi MAIL_POLL_SLICE và hộp thư thường rỗng: đọc thử trước, chỉ mở write tx khi có thư
+        if self.db.execute(
+                "SELECT 1 FROM mail WHERE kind=? AND username=? AND delivered=0 AND expires_at>? LIMIT 1",
+                (kind, username, time.time())).fetchone() is None:
+            return None
+        with self._tx() as db:
+            row = db.execute(
+                "SELECT id, body FROM mail WHERE kind=? AND username=? AND delivered=0 AND expires_at>? "
+                "ORDER BY id LIMIT 1", (kind, username, time.time())).fetchone()
+            if row is None: return None
+            if mark_delivered:
+                db.execute("UPDATE mail SET delivered=1, expires_at=MAX(expires_at, ?) WHERE id=?",
+                           (time.time() + self.answer_ttl, row["id"]))
+            else: db.execute("DELETE FROM mail WHERE id=?", (row["id"],))
+        return dict(json.loads(row["body"]), id=row["id"])
+
+    def resolve_invite(self, username, room_id):
+        with self._tx() as db:
+            row = db.execute(
+                "SELECT id, body FROM mail WHERE kind='invite' AND username=? AND room_id=? AND expires_at>? "
+                "ORDER BY id LIMIT 1", (username, room_id, time.time())).fetchone()
+            if row is None: return None
+            db.execute("DELETE FROM mail WHERE id=?", (row["id"],))
+        return dict(json.loads(row["body"]), id=row["id"])
+
+    def expire(self):
+        # Index trên expires_at: chỉ chạm vào các dòng đã hết hạn
+        now = time.time()
+        with self._tx() as db:
+            left = [r[0] for r in db.execute("DELETE FROM users WHERE expires_at<=? RETURNING username", (now,)).fetchall()]
+            db.executemany("INSERT INTO lobby_log (type, username) VALUES ('leave', ?)", [(u,) for u in left])
+            freed = db.execute("DELETE FROM rooms WHERE expires_at<=? RETURNING room_id", (now,)).fetchall()
+            db.executemany("INSERT OR IGNORE INTO room_free VALUES (?, ?)", [(r[0], now) for r in freed])
+            mail = db.execute("DELETE FROM mail WHERE expires_at<=? RETURNING kind", (now,)).fetchall()
+            tickets = db.execute("DELETE FROM mm_queue WHERE enqueued_at<=?", (now - self.ticket_ttl,)).rowcount
+            db.execute("DELETE FROM lobby_log WHERE v <= (SELECT MAX(v) FROM lobby_log) - ?", (self.log_size,))
+        self._count_evicted("user", len(left))
+        self._count_evicted("room", len(freed))
+        for row in mail: self._count_evicted(row[0])
+        self._count_evicted("mm", tickets)
+        return left
+
+    def mm_enqueue(self, ticket):
+        with self._tx() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO mm_queue VALUES (:username, :game_type, :region, :bucket, :rating, :ip, :port, :enqueued_at)",
+                ticket)
+            db.execute("INSERT OR IGNORE INTO mm_dirty VALUES (:game_type, :region, :bucket)", ticket)
+
+    def mm_cancel(self, username):
+        with self._tx() as db:
+            return db.execute("DELETE FROM mm_queue WHERE username=?", (username,)).rowcount > 0
+
+    def mm_ticket(self, username):
+        row = self.db.execute("SELECT * FROM mm_queue WHERE username=?", (username,)).fetchone()
+        return dict(row) if row else None
+
+    def mm_match(self, widen_after):
+        # Như MemoryStore: chỉ ghép lại bucket có vé mới (bảng mm_dirty), không đọc cả hàng đợi mỗi tick.
+        # Mỗi worker lấy và xoá mm_dirty trong cùng transaction nên không ghép trùng.
+        now = time.time()
+        cutoff = now - self.ticket_ttl
+        full = now - self.mm_widened_at >= WIDEN_SCAN_INTERVAL
+        if not full and self.db.execute("SELECT 1 FROM mm_dirty LIMIT 1").fetchone() is None: return []
+        pairs = []
+        with self._tx() as db:
+            dirty = db.execute("DELETE FROM mm_dirty RETURNING game_type, region, bucket").fetchall()
+            for key in dirty:
+                rows = db.execute(
+                    "SELECT * FROM mm_queue WHERE game_type=? AND region=? AND bucket=? AND enqueued_at>? "
+                    "ORDER BY enqueued_at", (*key, cutoff)).fetchall()
+                pairs.extend(pair_tickets([dict(r) for r in rows], now, widen_after))
+            db.executemany("DELETE FROM mm_queue WHERE username=?", [(t["username"],) for p in pairs for t in p])
+            # Mỗi bucket còn tối đa 1 vé (vé cũ nhất nếu lượt trước bị gián đoạn): nới rating sang bucket lân cận
+            sql = "SELECT username, game_type, region, bucket, rating, ip, port, MIN(enqueued_at) AS enqueued_at " \
+                  "FROM mm_queue WHERE enqueued_at>?"
+            if full:
+                # Nhóm chỉ có 1 bucket thì không có gì để nới: lọc ngay trong SQL
+                rows = db.execute(
+                    sql + " AND (game_type, region) IN (SELECT game_type, region FROM mm_queue WHERE enqueued_at>? "
+                    "GROUP BY game_type, region HAVING COUNT(DISTINCT bucket)>1) GROUP BY game_type, region, bucket",
+                    (cutoff, cutoff)).fetchall()
+            else:
+                rows = []
+                for group in {tuple(key)[:2] for key in dirty}:
+                    rows += db.execute(sql + " AND game_type=? AND region=? GROUP BY bucket", (cutoff, *group)).fetchall()
+            groups: Dict[Tuple[str, str], List[Dict]] = {}
+            for row in rows: groups.setdefault((row["game_type"], row["region"]), []).append(dict(row))
+            widened = []
+            for singles in groups.values():
+                if len(singles) < 2: continue
+                singles.sort(key=lambda t: t["bucket"])
+                widened.extend(pair_tickets(singles, now, widen_after))
+            db.executemany("DELETE FROM mm_queue WHERE username=?", [(t["username"],) for p in widened for t in p])
+        if full: self.mm_widened_at = now
+        return pairs + widened
+
+    def mm_depth(self):
+        rows = self.db.execute(
+            "SELECT game_type, COUNT(*) FROM mm_queue WHERE enqueued_at>? GROUP BY game_type",
+            (time.time() - self.ticket_ttl,))
+        return {r[0]: r[1] for r in rows}
+
+    def counts(self):
+        now = time.time()
+        return {
+            "users": self.db.execute("SELECT COUNT(*) FROM users WHERE expires_at>?", (now,)).fetchone()[0],
+            "rooms": self.db.execute("SELECT COUNT(*) FROM rooms WHERE expires_at>?", (now,)).fetchone()[0],
+            "invites": self.db.execute("SELECT COUNT(*) FROM mail WHERE kind='invite' AND expires_at>?", (now,)).fetchone()[0],
+        }
+
+
+def open_store(backend: str, path: str, **limits) -> StateStore:
+    if backend == "memory": return MemoryStore(**limits)
+    if backend == "sqlite": return SqliteStore(path, **limits)
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
@@ -0,0 +1,63 @@
+# test_relay.py - Kiểm tra relay TCP trên cổng ngẫu nhiên của localhost
+#
+#   python -m pytest -q
+import asyncio
+
+from relay import Relay
+
+
+async def start_relay() -> Relay:
+    relay = Relay(b"test-secret")
+    await relay.start("127.0.0.1", 0)
+    return relay
+
+
+async def connect(relay: Relay, room_id: str, role: str):
+    port = relay.server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(relay.issue_token(room_id, role).encode() + b"\n")
+    await writer.drain()
+    return reader, writer
+
+
+async def settle():
+    for _ in range(5): await asyncio.sleep(0.01)
+
+
+def test_relay_pairs_and_forwards():
+    async def main():
+        relay = await start_relay()
+        host_r, host_w = await connect(relay, "10001", "host")
+        host_w.write(b"early")   # gửi trước khi có OK: được giữ lại cho guest
+        await settle()
+        guest_r, guest_w = await connect(relay, "10001", "guest")
+        assert await host_r.readline() == b"OK\n"
+        assert await guest_r.readline() == b"OK\n"
+        assert await guest_r.readexactly(5) == b"early"
+        guest_w.write(b"ping")
+        assert await host_r.readexactly(4) == b"ping"
+        for w in (host_w, guest_w): w.close()
+        await relay.stop()
+    asyncio.run(main())
+
+
+def test_relay_drops_peer_that_disconnects_while_waiting():
+    async def main():
+        relay = await start_relay()
+        _, stale_w = await connect(relay, "10002", "host")
+        await settle()
+        assert relay.stats()["waiting"] == 1
+        stale_w.close()
+        await settle()
+        # Peer ngắt khi đang chờ rời session ngay: không bị coi là duplicate khi kết nối lại
+        assert relay.stats()["waiting"] == 0
+        host_r, host_w = await connect(relay, "10002", "host")
+        guest_r, guest_w = await connect(relay, "10002", "guest")
+        assert await host_r.readline() == b"OK\n"
+        assert await guest_r.readline() == b"OK\n"
+        host_w.write(b"move")
+        assert await guest_r.readexactly(4) == b"move"
+        assert relay.totals["rejected"] == 0
+        for w in (host_w, guest_w): w.close()
+        await relay.stop()
+    asyncio.run(main())
@@ -0,0 +1,203 @@
+# test_server.py - Kiểm tra API HTTP qua TestClient, trên store mới (memory và sqlite) cho mỗi test
+#
+#   python -m pytest -q
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from store import open_store
+
+LIMITS = dict(user_ttl=15, room_ttl=1800, mail_ttl=10, mail_limit=8, log_size=100, ticket_ttl=120)
+
+
+def make_client(monkeypatch, tmp_path, backend, **limits):
+    store = open_store(backend, str(tmp_path / "state.db"), **dict(LIMITS, **limits))
+    monkeypatch.setattr(server, "store", store)
+    monkeypatch.setattr(server, "users_cache", {})
+    return TestClient(server.app)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, backend):
+    with make_client(monkeypatch, tmp_path, backend) as c:
+        yield c
+
+
+def heartbeat(client, username, lobby_state="menu"):
+    r = client.post("/heartbeat", json={"username": username, "p2p_port": 40000, "lobby_state": lobby_state})
+    assert r.status_code == 200
+
+
+def test_since_delta_is_truncated_to_what_was_returned(monkeypatch, tmp_path, backend):
+    with make_client(monkeypatch, tmp_path, backend, log_size=5) as client:
+        since = client.get("/users", params={"since": "x"}).json()["since"]
+        for i in range(8):
+            heartbeat(client, f"u{i}")
+        # sqlite chỉ đọc tối đa log_size sự kiện mỗi lần: lặp theo "since" tới khi hết thay đổi
+        seen = set()
+        while True:
+            r = client.get("/users", params={"since": since})
+            data = r.json()
+            assert r.headers["ETag"] == f'"{data["since"]}"'
+            if data.get("full"):
+                seen = {u["username"] for u in data["users"]}
+            else:
+                seen |= {e["username"] for e in data["changes"]}
+            if data["since"] == since:
+                break
+            since = data["since"]
+        assert seen == {f"u{i}" for i in range(8)}
+        assert data["version"] == 8
+
+
+def test_users_etag_and_304(client):
+    heartbeat(client, "a")
+    r = client.get("/users")
+    etag = r.headers["ETag"]
+    assert r.json() == [{"username": "a", "lobby_state": "menu"}]
+    assert client.get("/users", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/users", headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    heartbeat(client, "a", "ingame")
+    r = client.get("/users", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["ETag"] != etag
+    assert r.json() == [{"username": "a", "lobby_state": "ingame"}]
+
+
+def test_since_cursor_is_scoped_by_epoch(client):
+    heartbeat(client, "a")
+    first = client.get("/users", params={"since": ""}).json()
+    assert first["full"] and first["users"] == [{"username": "a", "lobby_state": "menu"}]
+    heartbeat(client, "b")
+    heartbeat(client, "a", "ingame")
+    data = client.get("/users", params={"since": first["since"], "fields": "username"}).json()
+    assert [(e["type"], e["username"]) for e in data["changes"]] == [("join", "b"), ("state", "a")]
+    assert "lobby_state" not in data["changes"][0]
+    assert client.get("/users", params={"since": data["since"]}).json()["changes"] == []
+    # Cùng version nhưng epoch khác (server restart): không dùng delta, trả snapshot đầy đủ
+    version = first["since"].partition("-")[2]
+    stale = client.get("/users", params={"since": f"{server.store.epoch + 1}-{version}"}).json()
+    assert stale["full"] and {u["username"] for u in stale["users"]} == {"a", "b"}
+
+
+def test_heartbeat_fast_path_and_coercion(client):
+    assert client.post("/heartbeat", json={"username": "a", "p2p_port": 40000, "ip": "9.9.9.9"}).status_code == 200
+    assert server.store.get_user("a")["ip"] == "9.9.9.9"
+    # Kiểu lệch đi qua UserSignal: chuỗi số vẫn được ép thành int như trước
+    r = client.post("/heartbeat", json={"username": "b", "p2p_port": "40001", "lobby_state": "ingame"})
+    assert r.status_code == 200
+    assert server.store.get_user("b")["port"] == 40001
+    assert client.get("/users").json()[-1] == {"username": "b", "lobby_state": "ingame"}
+
+    r = client.post("/heartbeat", json={"username": "c", "p2p_port": "port"})
+    assert r.status_code == 422 and [e["loc"] for e in r.json()["detail"]] == [["body", "p2p_port"]]
+    r = client.post("/heartbeat", json={"p2p_port": 1})
+    assert r.status_code == 422 and [e["loc"] for e in r.json()["detail"]] == [["body", "username"]]
+    assert client.post("/heartbeat", content=b"not json").status_code == 422
+    assert server.store.get_user("c") is None
+
+
+def create_room(client, host):
+    r = client.post("/create-room", json={"username": host, "p2p_port": 40000, "game_type": "chess"})
+    assert r.status_code == 200
+    return r.json()["room_id"]
+
+
+def test_relay_token_only_for_guest_seat(client, monkeypatch):
+    room_id = create_room(client, "host")
+    assert client.post("/join-room", json={"username": "guest", "room_id": room_id, "relay": True}).status_code == 503
+    monkeypatch.setattr(server, "RELAY_PORT", 45999)
+    assert client.post("/join-room", json={"username": "host", "room_id": room_id, "relay": True}).status_code == 409
+
+    r = client.post("/join-room", json={"username": "guest", "room_id": room_id, "relay": True})
+    assert r.status_code == 200 and r.json()["relay"]["port"] == 45999
+    assert server.relay.verify_token(r.json()["relay"]["token"]) == (room_id, "guest")
+    offer = client.get("/relay/offers/host").json()
+    assert offer["guest_username"] == "guest"
+    assert server.relay.verify_token(offer["token"]) == (room_id, "host")
+
+    # Người khác biết room_id: vẫn xem được phòng nhưng không lấy được token relay
+    assert client.post("/join-room", json={"username": "mallory", "room_id": room_id}).status_code == 200
+    assert client.post("/join-room", json={"username": "mallory", "room_id": room_id, "relay": True}).status_code == 409
+    assert client.get("/relay/offers/host").json() == {"status": "none"}
+    assert client.post("/join-room", json={"username": "guest", "room_id": "00000", "relay": True}).status_code == 404
+
+
+def send_invite(client, challenger, target, room_id):
+    r = client.post("/send-invite", json={"challenger": challenger, "target": target, "room_id": room_id,
+                                           "game_type": "chess"})
+    return r.status_code
+
+
+def test_check_invite_long_poll_wakes_on_invite(client):
+    heartbeat(client, "b")
+    room_id = create_room(client, "a")
+    with ThreadPoolExecutor(1) as pool:
+        start = time.monotonic()
+        poll = pool.submit(client.get, "/check-invite/b", params={"wait": 10})
+        time.sleep(0.2)
+        assert send_invite(client, "a", "b", room_id) == 200
+        invite = poll.result(timeout=5).json()
+    # Được đánh thức ngay khi có lời mời, không đợi hết wait
+    assert time.monotonic() - start < 2
+    assert (invite["from"], invite["room_id"]) == ("a", room_id)
+    assert client.get("/check-invite/b").json() == {"status": "none"}
+    assert send_invite(client, "a", "offline", room_id) == 404
+
+
+def test_long_poll_ends_when_user_expires(monkeypatch, tmp_path, backend):
+    monkeypatch.setattr(server, "SWEEP_INTERVAL", 0.05)
+    with make_client(monkeypatch, tmp_path, backend, user_ttl=0.3) as client:
+        heartbeat(client, "a")
+        start = time.monotonic()
+        # Sweeper cho a offline và đánh thức long-poll đang chờ của a thay vì giữ tới hết wait
+        assert client.get("/check-invite/a", params={"wait": 10}).json() == {"status": "none"}
+        assert time.monotonic() - start < 2
+        assert server.store.get_user("a") is None
+
+
+def test_invite_accept_and_decline_replies(client):
+    heartbeat(client, "b")
+    room_a, room_c = create_room(client, "a"), create_room(client, "c")
+    assert send_invite(client, "a", "b", room_a) == 200
+    assert send_invite(client, "c", "b", room_c) == 200
+    assert client.get("/check-invite/b").json()["room_id"] == room_a
+    assert client.get("/check-invite/b").json()["room_id"] == room_c
+
+    with ThreadPoolExecutor(1) as pool:
+        reply = pool.submit(client.get, "/invite-replies/a", params={"wait": 10})
+        time.sleep(0.2)
+        assert client.post(f"/accept-invite/b/{room_a}").json() == {"status": "accepted"}
+        reply = reply.result(timeout=5).json()
+    assert (reply["status"], reply["by"], reply["room_id"]) == ("accepted", "b", room_a)
+
+    assert client.post(f"/decline-invite/b/{room_c}").json() == {"status": "declined"}
+    reply = client.get("/invite-replies/c").json()
+    assert (reply["status"], reply["by"], reply["room_id"]) == ("declined", "b", room_c)
+    # Mỗi lời mời chỉ trả lời được một lần; room không có lời mời -> expired
+    assert client.post(f"/accept-invite/b/{room_a}").json() == {"status": "expired"}
+    assert client.post(f"/decline-invite/b/{room_c}").json() == {"status": "expired"}
+    assert client.get("/invite-replies/a").json() == {"status": "none"}
+
+
+def test_sweeper_expires_users_without_requests(monkeypatch, tmp_path, backend):
+    monkeypatch.setattr(server, "SWEEP_INTERVAL", 0.05)
+    with make_client(monkeypatch, tmp_path, backend, user_ttl=0.3) as client:
+        heartbeat(client, "a")
+        since = client.get("/users", params={"since": ""}).json()["since"]
+        deadline = time.monotonic() + 0.6
+        while time.monotonic() < deadline:
+            heartbeat(client, "b")
+            time.sleep(0.05)
+        # Không request nào của a: sweeper chạy nền xoá a khi hết TTL, b vẫn online nhờ heartbeat
+        assert client.get("/users").json() == [{"username": "b", "lobby_state": "menu"}]
+        changes = client.get("/users", params={"since": since}).json()["changes"]
+        assert [(e["type"], e["username"]) for e in changes] == [("join", "b"), ("leave", "a")]
+        assert server.store.evicted == {"user": 1}
@@ -0,0 +1,211 @@
+# test_store.py - Kiểm tra store: cấp room_id, phân trang /rooms, expire, ghép trận; chạy trên cả MemoryStore và SqliteStore
+#
+#   python -m pytest -q
+import time
+
+import pytest
+
+from store import (ROOM_ID_BASE, ROOM_ID_SPACE, WIDEN_SCAN_INTERVAL, RoomsFull, SqliteStore, open_store,
+                   pair_tickets, permuted_room_id)
+
+LIMITS = dict(user_ttl=15, room_ttl=1800, mail_ttl=10, mail_limit=8, log_size=100, ticket_ttl=120)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    return open_store(request.param, str(tmp_path / "state.db"), **LIMITS)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Đồng hồ giả cho time.time(): cho phép tua tới lúc entry hết hạn
+    class Clock:
+        now = time.time()
+
+        def advance(self, seconds: float):
+            self.now += seconds
+
+    c = Clock()
+    monkeypatch.setattr(time, "time", lambda: c.now)
+    return c
+
+
+def new_room(store, host: str, game_type: str = "chess", created_at: float = None) -> str:
+    return store.create_room({
+        "host_username": host,
+        "host_ip": "1.2.3.4",
+        "host_port": 40000,
+        "game_type": game_type,
+        "created_at": time.time() if created_at is None else created_at,
+    })
+
+
+def skip_permutation(store, left: int):
+    # Bỏ qua phần đầu hoán vị thay vì tạo 90000 phòng: chỉ còn `left` ID chưa cấp
+    if isinstance(store, SqliteStore):
+        store.db.execute("UPDATE meta SET value=? WHERE key='room_count'", (ROOM_ID_SPACE - left,))
+    else:
+        store.room_count = ROOM_ID_SPACE - left
+
+
+def all_pages(store, game_type=None, host=None, limit=10):
+    rooms, cursor = [], 0
+    while cursor is not None:
+        page, cursor = store.list_rooms(game_type, host, cursor, limit)
+        assert len(page) <= limit
+        rooms += [r["room_id"] for r in page]
+    return rooms
+
+
+@pytest.mark.parametrize("offset", [0, 1, 12345, ROOM_ID_SPACE - 1])
+def test_permutation_gives_unique_five_digit_ids(offset):
+    ids = {permuted_room_id(n, offset) for n in range(ROOM_ID_SPACE)}
+    assert len(ids) == ROOM_ID_SPACE
+    assert min(ids) == str(ROOM_ID_BASE) and max(ids) == str(ROOM_ID_BASE + ROOM_ID_SPACE - 1)
+
+
+def test_room_ids_unique_until_space_runs_out(store):
+    ids = [new_room(store, f"h{i}") for i in range(500)]
+    assert len(set(ids)) == len(ids)
+    skip_permutation(store, 2)
+    new_room(store, "fresh")
+    old = new_room(store, "old", created_at=time.time() - LIMITS["room_ttl"] - 1)
+    with pytest.raises(RoomsFull):
+        new_room(store, "late")
+    # Hết hoán vị thì chỉ còn free-list: phòng hết hạn trả ID về để cấp lại
+    store.expire()
+    assert store.get_room(old) is None
+    assert new_room(store, "reuse") == old
+    with pytest.raises(RoomsFull):
+        new_room(store, "late")
+
+
+def test_list_rooms_pagination(store):
+    ids = [new_room(store, f"h{i % 3}", "chess" if i % 2 else "go") for i in range(25)]
+    taken = ids[4]
+    assert store.join_room(taken, "guest")["guest_username"] == "guest"
+    assert store.join_room(taken, "other")["guest_username"] == "guest"  # chỗ đã có người giữ
+    open_ids = [rid for rid in ids if rid != taken]
+    assert all_pages(store) == open_ids
+    assert all_pages(store, limit=1) == open_ids
+    assert all_pages(store, game_type="chess", limit=4) == [rid for i, rid in enumerate(ids) if i % 2 and rid != taken]
+    assert all_pages(store, host="h1", limit=3) == [rid for i, rid in enumerate(ids) if i % 3 == 1 and rid != taken]
+    assert all_pages(store, game_type="go", host="h0") == [
+        rid for i, rid in enumerate(ids) if i % 3 == 0 and i % 2 == 0 and rid != taken]
+    assert store.list_rooms("chess", "nobody", 0, 10) == ([], None)
+
+
+def test_expire(store, clock):
+    store.touch_user("a", "1.1.1.1", 1, "menu")
+    store.touch_user("b", "1.1.1.2", 2, "menu")
+    room = new_room(store, "a")
+    store.push_mail("invite", "a", {"from": "b", "room_id": room, "game_type": "chess", "timestamp": time.time()})
+    store.mm_enqueue({"username": "b", "game_type": "chess", "region": "eu", "bucket": 10, "rating": 1000,
+                      "ip": "1.1.1.2", "port": 2, "enqueued_at": time.time()})
+    assert store.expire() == []
+
+    clock.advance(10)
+    store.touch_user("b", "1.1.1.2", 2, "ingame")
+    clock.advance(6)
+    assert store.expire() == ["a"]
+    assert store.lobby_snapshot() == [{"username": "b", "lobby_state": "ingame"}]
+    assert store.take_mail("invite", "a") is None
+    assert store.mm_ticket("b") is not None
+    assert store.counts() == {"users": 1, "rooms": 1, "invites": 0}
+
+    clock.advance(LIMITS["ticket_ttl"])
+    assert store.expire() == ["b"]
+    assert store.mm_ticket("b") is None and store.mm_depth() == {}
+    assert store.get_room(room) is not None
+
+    clock.advance(LIMITS["room_ttl"])
+    assert store.expire() == []
+    assert store.get_room(room) is None
+    assert store.list_rooms(None, None, 0, 10) == ([], None)
+    assert store.counts() == {"users": 0, "rooms": 0, "invites": 0}
+    assert store.evicted == {"user": 2, "invite": 1, "mm": 1, "room": 1}
+    assert [e["type"] for e in store.lobby_log_since(0)] == ["join", "join", "state", "leave", "leave"]
+
+
+def invite(challenger: str, room_id: str) -> dict:
+    return {"from": challenger, "room_id": room_id, "game_type": "chess", "timestamp": time.time()}
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_mailbox_ttls_and_answer_window(backend, tmp_path, clock):
+    store = open_store(backend, str(tmp_path / "state.db"), **dict(LIMITS, answer_ttl=60, mail_ttls={"match": 120}))
+    for i in range(LIMITS["mail_limit"] + 2):
+        store.push_mail("invite", "b", invite(f"c{i}", "10001"))
+    # Mời lại cùng người: thay lời mời cũ (room mới), không thêm vào hàng đợi
+    store.push_mail("invite", "b", invite("c9", "10009"), replace_from="c9")
+    store.push_mail("match", "b", {"room_id": "10002", "timestamp": time.time()})
+    delivered = store.take_mail("invite", "b", mark_delivered=True)
+    assert delivered["from"] == "c2"   # hàng đợi giới hạn mail_limit: 2 lời mời cũ nhất bị bỏ
+
+    clock.advance(LIMITS["mail_ttl"] + 1)
+    assert store.take_mail("invite", "b") is None      # lời mời chưa giao hết hạn theo mail_ttl
+    assert store.resolve_invite("b", "10009") is None
+    assert store.resolve_invite("b", "10001")["from"] == "c2"   # đã giao: còn answer_ttl để trả lời
+    assert store.resolve_invite("b", "10001") is None
+    assert store.take_mail("match", "b")["room_id"] == "10002"  # TTL riêng theo loại mail
+
+    store.push_mail("invite", "b", invite("d", "10003"))
+    assert store.take_mail("invite", "b", mark_delivered=True)["from"] == "d"
+    clock.advance(60)
+    store.expire()
+    assert store.resolve_invite("b", "10003") is None
+    assert store.counts()["invites"] == 0
+
+
+def ticket(username: str, bucket: int, enqueued_at: float, game_type: str = "chess", region: str = "eu"):
+    return {"username": username, "game_type": game_type, "region": region, "bucket": bucket,
+            "rating": bucket * 100, "ip": "1.1.1.1", "port": 1, "enqueued_at": enqueued_at}
+
+
+def names(pairs):
+    return sorted((a["username"], b["username"]) for a, b in pairs)
+
+
+def test_pair_tickets_same_bucket_first():
+    tickets = [ticket("a", 5, 0), ticket("b", 5, 1), ticket("c", 5, 2), ticket("d", 6, 0)]
+    # a-b cùng bucket ghép trước; c lẻ ghép với d ở bucket kế bên khi đã được nới 1 bucket
+    assert names(pair_tickets(tickets, 4.9, 5)) == [("a", "b")]
+    assert names(pair_tickets(tickets, 5.0, 5)) == [("a", "b"), ("d", "c")]
+
+
+def test_pair_tickets_widening():
+    tickets = [ticket("a", 10, 3), ticket("b", 12, 0)]
+    assert pair_tickets(tickets, 9.9, 5) == []           # chờ 9.9s: mới nới 1 bucket
+    host, guest = pair_tickets(tickets, 10, 5)[0]        # chờ 10s (tính theo b): nới đủ 2 bucket
+    assert (host["username"], guest["username"]) == ("b", "a")  # người vào hàng trước làm host
+    far = [ticket("a", 0, 0), ticket("b", 7, 0), ticket("c", 9, 0)]
+    assert names(pair_tickets(far, 10, 5)) == [("b", "c")]
+
+
+def test_mm_match(store, clock):
+    now = time.time()
+    store.mm_enqueue(ticket("a", 10, now))
+    store.mm_enqueue(ticket("b", 12, now))
+    store.mm_enqueue(ticket("x", 10, now, region="us"))
+    store.mm_enqueue(ticket("y", 10, now, game_type="go"))
+    assert store.mm_match(5) == []
+    store.mm_enqueue(ticket("c", 10, now + 1))
+    assert names(store.mm_match(5)) == [("a", "c")]
+    assert store.mm_depth() == {"chess": 2, "go": 1}
+
+    # Huỷ rồi vào lại ở bucket khác: vé cũ không được ghép
+    store.mm_enqueue(ticket("d", 12, now + 2))
+    assert store.mm_cancel("d") and not store.mm_cancel("d")
+    store.mm_enqueue(ticket("e", 30, now + 2))
+    store.mm_enqueue(ticket("e", 12, now + 3))
+    assert names(store.mm_match(5)) == [("b", "e")]
+
+    # Vé lẻ ở bucket xa: chỉ được ghép sau khi chờ đủ lâu, bởi lượt quét định kỳ
+    store.mm_enqueue(ticket("f", 20, now + 3))
+    store.mm_enqueue(ticket("g", 22, now + 3))
+    assert store.mm_match(5) == []
+    clock.advance(13 + WIDEN_SCAN_INTERVAL)
+    assert names(store.mm_match(5)) == [("f", "g")]
+    assert store.mm_match(5) == []
+    assert store.mm_depth() == {"chess": 1, "go": 1}
+    assert store.mm_ticket("x") is not None and store.mm_ticket("f") is None